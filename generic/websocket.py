@@ -7,6 +7,7 @@ from ws4redis.redis_store import RedisStore, SELF
 from ws4redis.subscriber import RedisSubscriber
 
 events_route = RoutePattern('ws/<int:project_id>/events')
+jobs_route = RoutePattern('ws/jobs')
 
 
 # noinspection PyUnusedLocal
@@ -30,6 +31,16 @@ def get_allowed_channels(request, channels):
 
             raise PermissionDenied("No access to this exercise")
 
+        jobs = jobs_route.match(path_info)
+        if jobs:
+            extra_path, _args, _kwargs = jobs
+            if extra_path != '':
+                # We don't accept trailing garbage
+                raise Http404
+
+            # Progress of the user's own jobs
+            return {'subscribe-user'}
+
         # Fall through means nothing matched
         raise Http404
 
@@ -1,6 +1,8 @@
 from django import template
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
 from django.db.models import Count, Q
+from django.shortcuts import redirect
 from django.template.loader import render_to_string
 from django.urls import path, reverse
 from django.utils import timezone
@@ -11,11 +13,11 @@ from nested_admin.nested import NestedModelAdmin, NestedStackedInline
 
 import lab.views.admin
 from lab.forms import AddTemplateForm
-from lab.models import (Exercise, ExerciseNode, ExerciseState, IRRGoal, IRRNode, IRRTemplate, MonitorGoal, MonitorNode,
-                        MonitorTemplate, Template, WorkNode, irr_goal_types, monitor_goal_types)
+from lab.models import (CloneJob, Exercise, ExerciseNode, ExerciseState, IRRGoal, IRRNode, IRRTemplate, MonitorGoal,
+                        MonitorNode, MonitorTemplate, Template, WorkNode, irr_goal_types, monitor_goal_types)
+from lab.tasks import queue_start, queue_stop
 from lab.utils import get_unknown_nodes
 from lab.utils.diagram import ProjectDiagram
-from lab.utils.gns3 import get_gns3_session
 from lab.views.utils import DrawingView
 
 
@@ -85,16 +87,19 @@ class InlineIRRNodeAdmin(admin.StackedInline):
 
 @admin.register(Template)
 class TemplateAdmin(admin.ModelAdmin):
-    list_display = ('name', 'allow_new_exercises', 'default_time_limit', 'admin_nodes', 'admin_students')
+    list_display = ('name', 'allow_new_exercises', 'default_time_limit', 'admin_nodes', 'admin_students', 'admin_pool')
     list_filter = ('allow_new_exercises', 'default_time_limit')
-    readonly_fields = ('name', 'gns3_id',)
-    fields = ('name', 'gns3_id', 'instructions', 'allow_new_exercises', 'default_time_limit')
+    readonly_fields = ('name', 'gns3_id', 'pool_claims', 'cold_clones')
+    fields = ('name', 'gns3_id', 'instructions', 'allow_new_exercises', 'default_time_limit',
+              'warm_pool_size', 'warm_pool_refill_rate', 'pool_claims', 'cold_clones')
     ordering = ('name',)
     inlines = (InlineWorkNodeAdmin, InlineMonitorNodeAdmin, InlineIRRNodeAdmin)
+    actions = ['enroll_students']
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.annotate(student_count=Count('exercise'))
+        return qs.annotate(student_count=Count('exercise', filter=Q(exercise__student__isnull=False)),
+                           pool_count=Count('exercise', filter=Q(exercise__student__isnull=True)))
 
     def render_change_form(self, request, context, add=False, change=False, form_url='', obj=None):
         if obj and not add:
@@ -121,6 +126,8 @@ class TemplateAdmin(admin.ModelAdmin):
         urls = [
             path('<path:object_id>/nodes/add/', wrap(lab.views.admin.NodeAddView.as_view()), name='node_add'),
             path('<path:object_id>/students/add/', wrap(lab.views.admin.StudentAddView.as_view()), name='student_add'),
+            path('<path:object_id>/students/enroll/', wrap(lab.views.admin.StudentsEnrollView.as_view()),
+                 name='students_enroll'),
         ]
         urls += super().get_urls()
 
@@ -130,7 +137,8 @@ class TemplateAdmin(admin.ModelAdmin):
         if not obj:
             # Overrule default field set
             return [(None, {
-                'fields': ['available_templates', 'allow_new_exercises', 'default_time_limit']
+                'fields': ['available_templates', 'allow_new_exercises', 'default_time_limit',
+                           'warm_pool_size', 'warm_pool_refill_rate']
             })]
         return super().get_fieldsets(request, obj)
 
@@ -186,7 +194,8 @@ class TemplateAdmin(admin.ModelAdmin):
     def admin_students(self, instance):
         tpl = template.Template("""
              {% load i18n %}
-             <a href="{% url 'admin:lab_exercise_changelist' %}?based_on__project_ptr__exact={{ instance.pk }}">
+             {% url 'admin:lab_exercise_changelist' as exercises %}
+             <a href="{{ exercises }}?based_on__project_ptr__exact={{ instance.pk }}&pool=claimed">
                  {% blocktrans count count=instance.student_count %}
                      {{ count }} student
                  {% plural %}
@@ -195,6 +204,8 @@ class TemplateAdmin(admin.ModelAdmin):
              </a>
              <br>
              <a href="{% url 'admin:student_add' object_id=instance.id %}">{% trans "Add student" %}</a>
+             <br>
+             <a href="{% url 'admin:students_enroll' object_id=instance.id %}">{% trans "Enroll class" %}</a>
          """)
         return tpl.render(template.Context({
             'instance': instance
@@ -203,6 +214,41 @@ class TemplateAdmin(admin.ModelAdmin):
     admin_students.short_description = _('Students')
     admin_students.admin_order_field = 'student_count'
 
+    def admin_pool(self, instance):
+        tpl = template.Template("""
+             {% load i18n %}
+             {% url 'admin:lab_exercise_changelist' as exercises %}
+             <a href="{{ exercises }}?based_on__project_ptr__exact={{ instance.pk }}&pool=unclaimed">
+                 {% blocktrans with ready=instance.pool_count size=instance.warm_pool_size %}
+                     {{ ready }} of {{ size }} ready
+                 {% endblocktrans %}
+             </a>
+             <br>
+             {% blocktrans with rate=instance.warm_pool_refill_rate %}
+                 refills {{ rate }} per minute
+             {% endblocktrans %}
+             <br>
+             {% blocktrans with claims=instance.pool_claims cold=instance.cold_clones %}
+                 {{ claims }} from pool, {{ cold }} cold
+             {% endblocktrans %}
+         """)
+        return tpl.render(template.Context({
+            'instance': instance
+        }))
+
+    admin_pool.short_description = _('Warm pool')
+    admin_pool.admin_order_field = 'pool_count'
+
+    # noinspection PyMethodMayBeStatic
+    def enroll_students(self, request, queryset):
+        if queryset.count() != 1:
+            messages.error(request, _('Select one template to enroll students in'))
+            return None
+
+        return redirect('admin:students_enroll', object_id=queryset.get().id)
+
+    enroll_students.short_description = _('Enroll students')
+
 
 class InlineExerciseState(NestedStackedInline):
     model = ExerciseState
@@ -238,33 +284,76 @@ class InlineExerciseNode(NestedStackedInline):
         return False
 
 
+class WarmPoolFilter(admin.SimpleListFilter):
+    title = _('warm pool')
+    parameter_name = 'pool'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('claimed', _('Claimed by a student')),
+            ('unclaimed', _('Unclaimed')),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == 'claimed':
+            return queryset.filter(student__isnull=False)
+        if self.value() == 'unclaimed':
+            return queryset.filter(student__isnull=True)
+        return queryset
+
+
+class ExerciseChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+
+        # One batch for the whole page instead of a GNS3 request for every row
+        Exercise.prefetch_running(self.result_list)
+
+
 @admin.register(Exercise)
 class ExerciseAdmin(NestedModelAdmin):
     list_display = ('student', 'name', 'based_on', 'started', 'deadline', 'is_running', 'admin_dashboard')
-    list_filter = ('based_on', 'student')
+    list_filter = ('based_on', WarmPoolFilter, 'student')
     readonly_fields = ('name', 'gns3_id', 'admin_student', 'based_on', 'started')
     fields = ('name', 'gns3_id', 'admin_student', 'based_on', 'started', 'deadline')
     ordering = ('name',)
     inlines = (InlineExerciseNode,)
     actions = ['start_exercise', 'stop_exercise']
 
-    # noinspection PyMethodMayBeStatic
-    def start_exercise(self, _request, queryset):
-        session = get_gns3_session()
+    def get_changelist(self, request, **kwargs):
+        return ExerciseChangeList
+
+    def start_exercise(self, request, queryset):
+        skipped = []
         for exercise in queryset:
             exercise.deadline = None
             exercise.save()
-            exercise.gns3_start(session=session)
+            if not queue_start(exercise):
+                skipped.append(exercise.name)
+
+        queued = len(queryset) - len(skipped)
+        if queued:
+            self.message_user(request, _('Starting {count} exercises in the background').format(count=queued))
+        if skipped:
+            self.message_user(request, _('Already starting, stopping or reloading: {names}').format(
+                names=', '.join(skipped)), messages.WARNING)
 
     start_exercise.short_description = _('Start exercise')
 
-    # noinspection PyMethodMayBeStatic
-    def stop_exercise(self, _request, queryset):
-        session = get_gns3_session()
+    def stop_exercise(self, request, queryset):
+        skipped = []
         for exercise in queryset:
             exercise.deadline = timezone.now()
             exercise.save()
-            exercise.gns3_stop(session=session)
+            if not queue_stop(exercise):
+                skipped.append(exercise.name)
+
+        queued = len(queryset) - len(skipped)
+        if queued:
+            self.message_user(request, _('Stopping {count} exercises in the background').format(count=queued))
+        if skipped:
+            self.message_user(request, _('Already starting, stopping or reloading: {names}').format(
+                names=', '.join(skipped)), messages.WARNING)
 
     stop_exercise.short_description = _('Stop exercise')
 
@@ -283,7 +372,23 @@ class ExerciseAdmin(NestedModelAdmin):
     admin_dashboard.short_description = _('Dashboard')
 
     def admin_student(self, instance: Exercise):
+        if not instance.student:
+            # Still waiting in the warm pool
+            return _('Unclaimed')
+
         name = instance.student.get_full_name() or instance.student.username
         return "{name} ({email})".format(name=name, email=instance.student.email)
 
     admin_student.short_description = _('Student')
+
+
+@admin.register(CloneJob)
+class CloneJobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'student', 'template', 'state', 'created', 'updated', 'exercise')
+    list_filter = ('state', 'template')
+    readonly_fields = ('name', 'student', 'template', 'time_limit', 'state', 'error', 'exercise', 'created', 'updated')
+    fields = ('name', 'student', 'template', 'time_limit', 'state', 'error', 'exercise', 'created', 'updated')
+
+    def has_add_permission(self, request):
+        # Jobs are created by cloning a template
+        return False
@@ -8,5 +8,5 @@ class LabConfig(AppConfig):
 
     # noinspection PyUnresolvedReferences
     def ready(self):
-        from . import signals
+        from . import signals, tasks
         super().ready()
@@ -1,6 +1,6 @@
 from django.db.models import ForeignKey
 from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
-from django.forms import ModelChoiceField
+from django.forms import ModelChoiceField, ModelMultipleChoiceField
 from model_utils.managers import InheritanceManagerMixin
 
 
@@ -10,6 +10,12 @@ class UserModelChoiceField(ModelChoiceField):
         return "{name} ({email})".format(name=name, email=obj.email)
 
 
+class UserModelMultipleChoiceField(ModelMultipleChoiceField):
+    def label_from_instance(self, obj):
+        name = obj.get_full_name() or obj.username
+        return "{name} ({email})".format(name=name, email=obj.email)
+
+
 class InheritanceForwardManyToOneDescriptor(ForwardManyToOneDescriptor):
     def get_queryset(self, **hints):
         if isinstance(self.field.remote_field.model.objects, InheritanceManagerMixin):
@@ -4,9 +4,11 @@ from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 from django_registration.forms import RegistrationForm
 
-from lab.fields import UserModelChoiceField
+from lab.fields import UserModelChoiceField, UserModelMultipleChoiceField
 from lab.models import Template
+from lab.tasks import SPOOLER_PROCESSES
 from lab.utils import get_unknown_node_choices, get_unknown_project_choices
+from lab.utils.enrollment import parse_students
 
 User = get_user_model()
 
@@ -29,7 +31,8 @@ class AddTemplateForm(forms.ModelForm):
 
     class Meta:
         model = Template
-        fields = ('available_templates', 'allow_new_exercises', 'default_time_limit')
+        fields = ('available_templates', 'allow_new_exercises', 'default_time_limit',
+                  'warm_pool_size', 'warm_pool_refill_rate')
 
     def clean(self):
         if 'available_templates' in self.cleaned_data:
@@ -72,3 +75,31 @@ class StudentAddForm(forms.Form):
 
     def clean(self):
         super().clean()
+
+
+class StudentsEnrollForm(forms.Form):
+    students = UserModelMultipleChoiceField(label=_('Students'), queryset=get_user_model().objects.all(),
+                                            required=False)
+    student_list = forms.CharField(label=_('Student list'), required=False, widget=forms.Textarea,
+                                   help_text=_('CSV with a username or email address in the first column'))
+    time_limit = forms.IntegerField(label=_('Time limit'), required=False, help_text=_('in minutes'))
+    concurrency = forms.IntegerField(label=_('Concurrency'), min_value=1, max_value=SPOOLER_PROCESSES, initial=4,
+                                     help_text=_('Number of exercises being cloned at the same time'))
+
+    def clean(self):
+        super().clean()
+
+        students = list(self.cleaned_data.get('students') or [])
+        listed, unknown = parse_students(self.cleaned_data.get('student_list', ''))
+        if unknown:
+            self.add_error('student_list', _('Unknown students: {}').format(', '.join(unknown)))
+
+        for student in listed:
+            if student not in students:
+                students.append(student)
+
+        if not students and not unknown:
+            raise ValidationError(_('No students selected'), code='required')
+
+        self.cleaned_data['all_students'] = students
+        return self.cleaned_data
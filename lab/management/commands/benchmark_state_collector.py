@@ -0,0 +1,172 @@
+import json
+import multiprocessing
+import selectors
+import socket
+import time
+import uuid
+
+from django import db
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from lab.management.commands.benchmark_state_parser import bird_route_dump
+from lab.models import ExerciseNode, MonitorNode, Template
+from lab.mules.listen_state import LISTEN, ShardRoutes, StateConnection, StateStore, create_listen_socket
+from lab.utils.directory import NodeDirectory
+
+
+def mac_address(number: int) -> str:
+    return '02:00:' + ':'.join('{:02x}'.format(byte) for byte in number.to_bytes(4, 'big'))
+
+
+class BenchmarkConnection(StateConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.published = []
+
+    def publish(self, message: dict):
+        # Do the same work, except for talking to Redis
+        self.published.append(json.dumps(message, cls=DjangoJSONEncoder))
+
+
+def run_benchmark_shard(listen_sock: socket.socket, dump: str, flush_interval: float, results):
+    """
+    Accept state connections like a collector shard: parse, store and publish, without Redis
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(listen_sock, selectors.EVENT_READ, LISTEN)
+
+    store = StateStore(flush_interval)
+    directory = NodeDirectory()
+    directory.load()
+    routes = ShardRoutes()
+
+    while True:
+        for key, mask in selector.select(store.timeout()):
+            if key.data is LISTEN:
+                try:
+                    connection, address = listen_sock.accept()
+                except BlockingIOError:
+                    continue
+
+                connection.setblocking(False)
+                selector.register(connection, selectors.EVENT_READ,
+                                  BenchmarkConnection(connection, address, store, directory, routes, selector))
+                continue
+
+            sc = key.data
+            if sc.collect_data():
+                continue
+
+            sc.drop()
+            states = [json.loads(message) for message in sc.published]
+            results.put(('published', len(states) == 1 and states[0]['content'].split('\n', 1)[1] == dump))
+
+        written = store.written
+        store.flush()
+        if store.written > written:
+            results.put(('written', store.written - written))
+
+
+def send_states(port: int, dump: str, node_ids: list):
+    for number, node_id in enumerate(node_ids):
+        # Every report is different, so it is written and published
+        stream = ('*****[ UUID ]*****\n' + node_id + '\n'
+                  '*****[ Routes IPv4 ]*****\nReport {}\n'.format(number) + dump +
+                  '*****[ END ]*****\n').encode('utf-8')
+        with socket.create_connection(('127.0.0.1', port)) as connection:
+            connection.sendall(stream)
+
+
+class Command(BaseCommand):
+    help = 'Measure how many state connections a sharded collector parses, stores and publishes per second. ' \
+           'Uses a temporary template in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, default=1, help='Number of collector processes')
+        parser.add_argument('--connections', type=int, default=200,
+                            help='Number of monitor connections, each for a monitor of its own')
+        parser.add_argument('--clients', type=int, default=4, help='Number of processes sending states')
+        parser.add_argument('--routes', type=int, default=2000, help='Number of routes each monitor sends')
+        parser.add_argument('--flush-interval', type=float,
+                            default=settings.STATE_COLLECTOR.get('FLUSH_INTERVAL', 2),
+                            help='Seconds between writes to the database')
+
+    def handle(self, *args, **options):
+        dump = bird_route_dump(options['routes'])
+
+        # Monitors the collector knows, removed again afterwards
+        template = Template.objects.create(gns3_id=uuid.uuid4(), name='State collector benchmark')
+        try:
+            self.benchmark(template, dump, options)
+        finally:
+            template.delete()
+
+    def benchmark(self, template: Template, dump: str, options):
+        node_ids = []
+        for number in range(options['connections']):
+            name = 'monitor{}'.format(number)
+            monitor = MonitorNode.objects.create(project=template, gns3_id=uuid.uuid4(), name=name,
+                                                 mac_address=mac_address(number * 2))
+            node = ExerciseNode.objects.create(project=template, gns3_id=uuid.uuid4(), name=name,
+                                               mac_address=mac_address(number * 2 + 1), template_node=monitor)
+            node_ids.append(str(node.gns3_id))
+
+        # All shards listen on the same port, like the real collector
+        first = create_listen_socket('127.0.0.1', 0, reuse_port=True)
+        port = first.getsockname()[1]
+        sockets = [first] + [create_listen_socket('127.0.0.1', port, reuse_port=True)
+                             for shard in range(1, options['shards'])]
+
+        # Don't share database connections with the children
+        db.connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        shards = [context.Process(target=run_benchmark_shard,
+                                  args=(listen_sock, dump, options['flush_interval'], results), daemon=True)
+                  for listen_sock in sockets]
+        for shard in shards:
+            shard.start()
+
+        self.stdout.write("{shards} shards, {connections} connections of {size:.1f} kB".format(
+            shards=options['shards'], connections=options['connections'], size=len(dump) / 1e3))
+
+        try:
+            start = time.perf_counter()
+            clients = [context.Process(target=send_states, args=(port, dump, node_ids[client::options['clients']]),
+                                       daemon=True)
+                       for client in range(options['clients'])]
+            for client in clients:
+                client.start()
+
+            published = 0
+            failed = 0
+            written = 0
+            published_duration = None
+            while published < options['connections'] or written < options['connections']:
+                kind, value = results.get(timeout=60)
+                if kind == 'published':
+                    published += 1
+                    if not value:
+                        failed += 1
+                    if published == options['connections']:
+                        published_duration = time.perf_counter() - start
+                else:
+                    written += value
+            written_duration = time.perf_counter() - start
+        finally:
+            for shard in shards:
+                shard.terminate()
+
+        if failed:
+            raise CommandError("{} connections weren't parsed and published correctly".format(failed))
+
+        self.stdout.write("Published: {duration:.3f}s, {rate:.1f} connections/s, {speed:.1f} MB/s".format(
+            duration=published_duration, rate=options['connections'] / published_duration,
+            speed=options['connections'] * len(dump) / 1e6 / published_duration))
+        self.stdout.write(self.style.SUCCESS(
+            "Written to the database: {duration:.3f}s, {rate:.1f} connections/s (flushing every {interval}s)".format(
+                duration=written_duration, rate=options['connections'] / written_duration,
+                interval=options['flush_interval'])))
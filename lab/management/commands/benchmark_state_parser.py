@@ -0,0 +1,86 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lab.mules.listen_state import StateConnection
+
+
+class FakeSocket:
+    """
+    Hands out the prepared data in chunks of the given size, like a socket would
+    """
+
+    def __init__(self, data: bytes, chunk_size: int):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def recv(self, size):
+        chunk = self.data[self.position:self.position + min(size, self.chunk_size)]
+        self.position += len(chunk)
+        return chunk
+
+
+class BenchmarkConnection(StateConnection):
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.sections = []
+
+    def submit(self):
+        # Only remember what would have been stored
+        if self.current_section_name:
+            self.sections.append((self.current_section_name, self.current_section))
+
+        self.current_section_name = None
+        self.current_section = ''
+
+
+def bird_route_dump(routes: int) -> str:
+    lines = ['BIRD 2.0.7 ready.', 'Table master4:']
+    for i in range(routes):
+        prefix = '10.{}.{}.0/24'.format(i // 256 % 256, i % 256)
+        lines.append('{prefix:<20} unicast [peer_{peer} {date}] * (100) [AS{asn}i]'.format(
+            prefix=prefix, peer=i % 4, date='2026-10-18', asn=64500 + i % 100))
+        lines.append('\tvia 192.0.2.{gw} on eth{eth}'.format(gw=i % 250 + 1, eth=i % 4))
+
+    # Make sure multi-byte characters get split across reads now and then
+    lines.append('Description: route server één → twéé')
+    return '\n'.join(lines) + '\n'
+
+
+class Command(BaseCommand):
+    help = 'Measure how fast state connections parse a large synthetic BIRD route dump'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=100000, help='Number of routes in the dump')
+        parser.add_argument('--chunk-size', type=int, default=1460, help='Bytes returned per recv() call')
+        parser.add_argument('--rounds', type=int, default=3, help='Number of times to run the benchmark')
+
+    def handle(self, *args, **options):
+        dump = bird_route_dump(options['routes'])
+        stream = ('*****[ UUID ]*****\n00000000-0000-0000-0000-000000000000\n'
+                  '*****[ Routes IPv4 ]*****\n' + dump +
+                  '*****[ END ]*****\n').encode('utf-8')
+
+        self.stdout.write("{routes} routes, {size:.1f} MB in chunks of {chunk} bytes".format(
+            routes=options['routes'], size=len(stream) / 1e6, chunk=options['chunk_size']))
+
+        best = None
+        for round_nr in range(options['rounds']):
+            connection = BenchmarkConnection(FakeSocket(stream, options['chunk_size']))
+
+            start = time.perf_counter()
+            while connection.collect_data():
+                pass
+            duration = time.perf_counter() - start
+
+            sections = dict(connection.sections)
+            if sections.get('Routes IPv4') != dump:
+                raise CommandError("Parsed section doesn't match the dump")
+
+            best = duration if best is None else min(best, duration)
+            self.stdout.write("Round {round}: {duration:.3f}s, {speed:.1f} MB/s".format(
+                round=round_nr + 1, duration=duration, speed=len(stream) / 1e6 / duration))
+
+        self.stdout.write(self.style.SUCCESS("Best: {duration:.3f}s, {speed:.1f} MB/s".format(
+            duration=best, speed=len(stream) / 1e6 / best)))
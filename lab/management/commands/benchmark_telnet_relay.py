@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lab.mules.telnet_relay import DO, IAC, TelnetRelay, WILL
+
+# What a router console says when someone connects
+NEGOTIATION = bytes((IAC, WILL, 1, IAC, WILL, 3, IAC, DO, 24, IAC, DO, 31))
+
+
+def show_output(size: int) -> bytes:
+    line = b'*> 10.0.0.0/24      192.0.2.1                0             0 64500 64501 i\r\n'
+    return (line * (size // len(line) + 1))[:size] + b'router# '
+
+
+class FakeConsole:
+    """
+    A telnet server that answers every line with a burst of output, in pieces like a slow terminal
+    """
+
+    def __init__(self, output: bytes, piece_size: int):
+        self.output = output
+        self.piece_size = piece_size
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(NEGOTIATION)
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            for position in range(0, len(self.output), self.piece_size):
+                writer.write(self.output[position:position + self.piece_size])
+                await writer.drain()
+        writer.close()
+
+
+class BenchmarkRelay(TelnetRelay):
+    def __init__(self, consoles: dict):
+        super().__init__()
+        self.consoles = consoles
+        self.received = {}
+        self.waiters = {}
+
+    def find_console(self, exercise_id: int, node_id: int):
+        return self.consoles[(exercise_id, node_id)]
+
+    def publish_output(self, key: tuple, data: bytes):
+        # Do the same work, except for talking to Redis
+        message = self.output_message(key[1], data)
+        self.metrics.published(len(message.encode('utf-8')))
+
+        self.received[key] = self.received.get(key, 0) + len(data)
+        waiter = self.waiters.get(key)
+        if waiter and self.received[key] >= waiter[0] and not waiter[1].done():
+            waiter[1].set_result(None)
+
+    async def command(self, key: tuple, expected: int):
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters[key] = (self.received.get(key, 0) + expected, waiter)
+        self.handle_input(key, b'show ip bgp\r\n')
+        await waiter
+
+
+class Command(BaseCommand):
+    help = 'Measure how many console sessions the telnet relay keeps up with, using local fake telnet servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=300, help='Number of console sessions')
+        parser.add_argument('--commands', type=int, default=20, help='Commands typed in every session')
+        parser.add_argument('--output-size', type=int, default=16384, help='Bytes of output per command')
+        parser.add_argument('--piece-size', type=int, default=512, help='Bytes the console writes at once')
+        parser.add_argument('--format', choices=['json', 'compact'], default='json', help='Terminal output format')
+
+    def handle(self, *args, **options):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.benchmark(options))
+        finally:
+            loop.close()
+
+    async def benchmark(self, options):
+        output = show_output(options['output_size'])
+        console = FakeConsole(output, options['piece_size'])
+
+        servers = []
+        consoles = {}
+        for node_id in range(options['sessions']):
+            server = await asyncio.start_server(console.handle, '127.0.0.1', 0)
+            servers.append(server)
+            consoles[(1, node_id)] = server.sockets[0].getsockname()[:2]
+
+        relay = BenchmarkRelay(consoles)
+        relay.frame_format = options['format']
+        latencies = []
+
+        async def type_commands(key):
+            for command_nr in range(options['commands']):
+                start = time.perf_counter()
+                await relay.command(key, len(output))
+                latencies.append(time.perf_counter() - start)
+
+        try:
+            start = time.perf_counter()
+            await asyncio.wait_for(asyncio.gather(*[type_commands(key) for key in consoles]), 300)
+            duration = time.perf_counter() - start
+        except asyncio.TimeoutError:
+            raise CommandError("The relay didn't keep up")
+        finally:
+            tasks = [session.task for session in relay.sessions.values() if session and session.task]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            # Let the consoles see the end of their connections
+            for server in servers:
+                server.close()
+                await server.wait_closed()
+            await asyncio.sleep(0.1)
+
+        latencies.sort()
+        total = options['sessions'] * options['commands'] * len(output)
+        self.stdout.write("{sessions} sessions, {commands} commands of {size} bytes each".format(
+            sessions=options['sessions'], commands=options['commands'], size=len(output)))
+        self.stdout.write("{reads} reads, {messages} messages, {per_message:.0f} bytes per message".format(
+            reads=relay.metrics.reads, messages=relay.metrics.messages,
+            per_message=relay.metrics.message_bytes / max(relay.metrics.messages, 1)))
+        self.stdout.write(self.style.SUCCESS(
+            "{duration:.2f}s, {speed:.1f} MB/s, command latency median {median:.1f}ms, 99% {p99:.1f}ms".format(
+                duration=duration, speed=total / 1e6 / duration,
+                median=latencies[len(latencies) // 2] * 1000,
+                p99=latencies[int(len(latencies) * 0.99)] * 1000)))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from lab.models import Template
+from lab.utils.enrollment import enroll_students, parse_students
+
+
+class Command(BaseCommand):
+    help = 'Clone a template for many students at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('template', help='ID or name of the template')
+        parser.add_argument('students', nargs='*', help='Usernames or email addresses of the students')
+        parser.add_argument('--csv', dest='csv_file', help='CSV file with a username or email address per row')
+        parser.add_argument('--time-limit', type=int, default=None, help='Time limit in minutes')
+        parser.add_argument('--concurrency', type=int, default=4, help='Number of clones running at the same time')
+
+    def handle(self, *args, **options):
+        query = Q(name=options['template'])
+        if options['template'].isdigit():
+            query |= Q(pk=options['template'])
+
+        try:
+            template = Template.objects.get(query)
+        except (Template.DoesNotExist, Template.MultipleObjectsReturned):
+            raise CommandError("Template {} not found".format(options['template']))
+
+        text = '\n'.join(options['students'])
+        if options['csv_file']:
+            with open(options['csv_file'], newline='') as csv_file:
+                text += '\n' + csv_file.read()
+
+        students, unknown = parse_students(text)
+        for identifier in unknown:
+            self.stderr.write(self.style.WARNING("Unknown student: {}".format(identifier)))
+
+        if not students:
+            raise CommandError("No students to enroll")
+
+        time_limit = options['time_limit']
+        if time_limit is None:
+            time_limit = template.default_time_limit
+
+        report = enroll_students(template, students, time_limit=time_limit, concurrency=options['concurrency'])
+
+        for result in report.results:
+            if result.success:
+                self.stdout.write(self.style.SUCCESS("{student}: {exercise} ({duration:.1f}s)".format(
+                    student=result.student, exercise=result.exercise.name, duration=result.duration)))
+            else:
+                self.stdout.write(self.style.ERROR("{student}: {error} ({duration:.1f}s)".format(
+                    student=result.student, error=result.error, duration=result.duration)))
+
+        self.stdout.write("{succeeded} enrolled, {failed} failed in {wall_time:.1f}s "
+                          "({throughput:.1f} exercises per minute)".format(succeeded=report.succeeded,
+                                                                           failed=report.failed,
+                                                                           wall_time=report.wall_time,
+                                                                           throughput=report.throughput))
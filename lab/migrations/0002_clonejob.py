@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lab', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloneJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='name')),
+                ('time_limit', models.PositiveIntegerField(blank=True, help_text='in minutes', null=True,
+                                                           verbose_name='time limit')),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('duplicating', 'Duplicating'),
+                                                    ('matching', 'Matching nodes'), ('starting', 'Starting'),
+                                                    ('done', 'Done'), ('failed', 'Failed')], default='queued',
+                                           max_length=20, verbose_name='state')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('exercise', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                                               to='lab.Exercise', verbose_name='exercise')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                              to=settings.AUTH_USER_MODEL, verbose_name='student')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lab.Template',
+                                               verbose_name='template')),
+            ],
+            options={
+                'verbose_name': 'clone job',
+                'verbose_name_plural': 'clone jobs',
+                'ordering': ('-created',),
+            },
+        ),
+    ]
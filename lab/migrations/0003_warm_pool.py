@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('lab', '0002_clonejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='template',
+            name='cold_clones',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='cold clones'),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='pool_claims',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='exercises from pool'),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='warm_pool_refill_rate',
+            field=models.PositiveIntegerField(default=1, help_text='Exercises added to the pool per minute',
+                                              verbose_name='warm pool refill rate'),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='warm_pool_size',
+            field=models.PositiveIntegerField(default=0,
+                                              help_text='Number of stopped exercises to keep ready for new students',
+                                              verbose_name='warm pool size'),
+        ),
+        migrations.AlterField(
+            model_name='exercise',
+            name='student',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT,
+                                    to=settings.AUTH_USER_MODEL, verbose_name='student'),
+        ),
+    ]
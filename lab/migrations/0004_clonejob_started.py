@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('lab', '0003_warm_pool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clonejob',
+            name='started',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='started'),
+        ),
+    ]
@@ -1,17 +1,24 @@
+import json
 from datetime import timedelta
+from uuid import uuid4
 
 from django.conf.global_settings import AUTH_USER_MODEL
 from django.db import models
+from django.db.models import F
 from django.db.transaction import atomic
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from macaddress.fields import MACAddressField
 from model_utils.managers import InheritanceManager
-from requests import RequestException, Session
+from requests import RequestException
+from ws4redis.redis_store import RedisMessage
 
+from generic.websocket import LabPublisher
 from lab.fields import InheritanceForeignKey
 from lab.utils import get_gns3_nodes
-from lab.utils.gns3 import fix_monitor_option, get_gns3_node, get_gns3_session, gns3_base_url, monitor_option
+from lab.utils.gns3 import (GNS3Client, fix_monitor_option, get_gns3_client, get_gns3_node, gns3_base_url,
+                             monitor_option)
+from lab.utils.inventory import get_gns3_node_inventory, get_running_states, running_state
 
 monitor_goal_type_choices = (
     ('Routes IPv4', _('IPv4 routes')),
@@ -55,6 +62,14 @@ class Template(Project):
     instructions = models.TextField(verbose_name=_('exercise instructions'), blank=True,
                                     help_text=_('Use markdown for styling'))
 
+    warm_pool_size = models.PositiveIntegerField(verbose_name=_('warm pool size'), default=0,
+                                                 help_text=_('Number of stopped exercises to keep ready '
+                                                             'for new students'))
+    warm_pool_refill_rate = models.PositiveIntegerField(verbose_name=_('warm pool refill rate'), default=1,
+                                                        help_text=_('Exercises added to the pool per minute'))
+    pool_claims = models.PositiveIntegerField(verbose_name=_('exercises from pool'), default=0, editable=False)
+    cold_clones = models.PositiveIntegerField(verbose_name=_('cold clones'), default=0, editable=False)
+
     class Meta:
         verbose_name = _('exercise template')
         verbose_name_plural = _('exercise templates')
@@ -67,11 +82,28 @@ class Template(Project):
         name = name.strip(':_- ')
         return name
 
-    @atomic
-    def clone(self, name: str, student: AUTH_USER_MODEL, time_limit=None):
+    def get_exercise_name(self, student: AUTH_USER_MODEL):
+        # Add student name to project name
+        return self.public_name + ' for ' + (student.get_full_name() or student.get_username())
+
+    @staticmethod
+    def get_deadline(time_limit=None):
+        if time_limit:
+            return timezone.now() + timedelta(minutes=time_limit)
+
+        return None
+
+    def duplicate(self, name: str, student: AUTH_USER_MODEL = None, time_limit=None, progress=None):
+        """
+        Create a stopped copy of this template, leave out the student to create one for the warm pool
+        """
         gns3_id = str(self.gns3_id).lower()
 
-        session = get_gns3_session()
+        session = get_gns3_client()
+
+        # Progress is saved outside of any transaction, so others can follow it
+        if progress:
+            progress(CloneJob.DUPLICATING)
 
         # We can only duplicate if the project is stopped
         # This should be the current state of templates anyway, but let's make sure...
@@ -80,56 +112,111 @@ class Template(Project):
             'name': name,
         }).json()
 
+        exercise = None
         try:
             # Open the project so its data becomes available in the API
             exercise_base_url = gns3_base_url + '/v2/projects/' + result['project_id']
             session.post(exercise_base_url + '/open')
 
-            # Store the exercise
-            exercise = Exercise(gns3_id=result['project_id'], name=name, student=student, based_on=self)
-            if time_limit:
-                exercise.deadline = timezone.now() + timedelta(minutes=time_limit)
-            exercise.save()
+            if progress:
+                progress(CloneJob.MATCHING)
 
             # The nodes will have different IDs, match them on MAC fix_address
-            server_nodes = get_gns3_nodes(exercise.gns3_id)
-            for template_node in TemplateNode.objects.select_subclasses().filter(project=self):
-                for server_node in server_nodes:
-                    if server_node.get('properties', {}).get('mac_address') == template_node.mac_address:
-                        break
-
-                    # GNS3 Server 2.1.13 randomizes MAC addresses
-                    if server_node.get('name') == template_node.name:
-                        break
-                else:
-                    raise RuntimeError(_("Node {node.name} ({node.mac_address}) not found in cloned project")
-                                       .format(node=template_node))
-
-                new_node = ExerciseNode(
-                    project=exercise,
-                    gns3_id=server_node['node_id'],
-                    name=server_node['name'],
-                    mac_address=server_node['properties']['mac_address'],
-                    template_node=template_node
-                )
-                new_node.save()
-
-                # Make sure the monitor option is present when needed
+            server_nodes = get_gns3_node_inventory(result['project_id'])
+
+            # Only the database writes in the transaction, the GNS3 calls can take a long time
+            with atomic():
+                # Store the exercise
+                new_exercise = Exercise(gns3_id=result['project_id'], name=name, student=student, based_on=self,
+                                        deadline=self.get_deadline(time_limit))
+                new_exercise.save()
+
+                new_nodes = []
+                for template_node in TemplateNode.objects.select_subclasses().filter(project=self):
+                    # GNS3 Server 2.1.13 randomizes MAC addresses, so fall back to the name
+                    server_node = (server_nodes.get_by_mac(template_node.mac_address) or
+                                   server_nodes.get_by_name(template_node.name))
+                    if not server_node:
+                        raise RuntimeError(_("Node {node.name} ({node.mac_address}) not found in cloned project")
+                                           .format(node=template_node))
+
+                    new_node = ExerciseNode(
+                        project=new_exercise,
+                        gns3_id=server_node['node_id'],
+                        name=server_node['name'],
+                        mac_address=server_node['properties']['mac_address'],
+                        template_node=template_node
+                    )
+                    new_node.save()
+                    new_nodes.append(new_node)
+
+            exercise = new_exercise
+
+            # Make sure the monitor option is present when needed
+            for new_node in new_nodes:
                 new_node.gns3_update_monitor_option(session=session)
 
         except Exception:
-            # Clean up: remove the created project
-            session.delete(gns3_base_url + '/v2/projects/' + result['project_id'])
+            # Clean up: remove the created project, together with the exercise if it was already stored
+            if exercise:
+                exercise.delete()
+            else:
+                session.delete(gns3_base_url + '/v2/projects/' + result['project_id'])
             raise
 
+        return exercise
+
+    def fill_pool(self):
+        # GNS3 wants unique project names
+        return self.duplicate(name='{name} (pool {id})'.format(name=self.public_name, id=uuid4().hex[:8]))
+
+    def claim_from_pool(self, name: str, student: AUTH_USER_MODEL, time_limit=None):
+        for exercise in Exercise.objects.filter(based_on=self, student__isnull=True).order_by('id'):
+            # Only one of the concurrent claims can make this update. Don't touch fields of Project here, that
+            # would split it into multiple queries.
+            claimed = Exercise.objects.filter(pk=exercise.pk, student__isnull=True).update(
+                student=student,
+                started=timezone.now(),
+                deadline=self.get_deadline(time_limit),
+            )
+            if not claimed:
+                continue
+
+            Template.objects.filter(pk=self.pk).update(pool_claims=F('pool_claims') + 1)
+            exercise.refresh_from_db()
+            exercise.name = name
+            exercise.save(update_fields=['name'])
+
+            try:
+                get_gns3_client().put(gns3_base_url + '/v2/projects/' + str(exercise.gns3_id).lower(), json={
+                    'name': name,
+                })
+            except RequestException:
+                pass
+
+            return exercise
+
+        return None
+
+    def clone(self, name: str, student: AUTH_USER_MODEL, time_limit=None, progress=None):
+        exercise = self.claim_from_pool(name=name, student=student, time_limit=time_limit)
+        if not exercise:
+            exercise = self.duplicate(name=name, student=student, time_limit=time_limit, progress=progress)
+            Template.objects.filter(pk=self.pk).update(cold_clones=F('cold_clones') + 1)
+
         # Start exercise
-        exercise.gns3_start(session=session)
+        if progress:
+            progress(CloneJob.STARTING, exercise=exercise)
+
+        exercise.gns3_start()
 
         return exercise
 
 
 class Exercise(Project):
-    student = models.ForeignKey(verbose_name=_('student'), to=AUTH_USER_MODEL, on_delete=models.PROTECT)
+    # Exercises without a student are waiting in the warm pool of their template
+    student = models.ForeignKey(verbose_name=_('student'), to=AUTH_USER_MODEL, null=True, blank=True,
+                                on_delete=models.PROTECT)
     based_on = models.ForeignKey(verbose_name=_('template'), to=Template, on_delete=models.PROTECT)
 
     started = models.DateTimeField(verbose_name=_('started'), auto_now_add=True)
@@ -145,26 +232,35 @@ class Exercise(Project):
         return now < self.deadline
 
     def is_running(self):
+        if hasattr(self, 'prefetched_running'):
+            return self.prefetched_running
+
         try:
             nodes = get_gns3_nodes(str(self.gns3_id))
         except RequestException:
             return None
 
-        total = len(nodes)
-        running = len([node for node in nodes if node['status'] == 'started'])
-        if running == total:
-            return True
-        elif running == 0:
-            return False
-        else:
-            return None
+        return running_state(nodes)
 
     is_running.short_description = _('Running')
     is_running.boolean = True
 
+    @staticmethod
+    def prefetch_running(exercises):
+        # Determine the running state of a whole page of exercises in one go
+        exercises = list(exercises)
+        states = get_running_states(exercise.gns3_id for exercise in exercises)
+        for exercise in exercises:
+            exercise.prefetched_running = states.get(str(exercise.gns3_id).lower())
+
+    def publish_event(self, data: dict):
+        # Everybody watching the dashboard of this exercise gets the event
+        redis_publisher = LabPublisher(facility='{}/events'.format(self.id), broadcast=True)
+        redis_publisher.publish_message(RedisMessage(json.dumps(data)))
+
     def gns3_start(self, *, session=None):
         if not session:
-            session = get_gns3_session()
+            session = get_gns3_client()
 
         try:
             session.put(gns3_base_url + '/v2/projects/' + str(self.gns3_id).lower(), json={
@@ -178,7 +274,7 @@ class Exercise(Project):
 
     def gns3_stop(self, *, session=None):
         if not session:
-            session = get_gns3_session()
+            session = get_gns3_client()
 
         try:
             session.put(gns3_base_url + '/v2/projects/' + str(self.gns3_id).lower(), json={
@@ -192,7 +288,7 @@ class Exercise(Project):
 
     def gns3_delete(self, *, session=None):
         if not session:
-            session = get_gns3_session()
+            session = get_gns3_client()
 
         self.gns3_stop(session=session)
         try:
@@ -205,6 +301,70 @@ class Exercise(Project):
         verbose_name_plural = _('exercises')
 
 
+class CloneJob(models.Model):
+    QUEUED = 'queued'
+    DUPLICATING = 'duplicating'
+    MATCHING = 'matching'
+    STARTING = 'starting'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    state_choices = (
+        (QUEUED, _('Queued')),
+        (DUPLICATING, _('Duplicating')),
+        (MATCHING, _('Matching nodes')),
+        (STARTING, _('Starting')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+    pending_states = (QUEUED, DUPLICATING, MATCHING, STARTING)
+
+    template = models.ForeignKey(verbose_name=_('template'), to=Template, on_delete=models.CASCADE)
+    student = models.ForeignKey(verbose_name=_('student'), to=AUTH_USER_MODEL, on_delete=models.CASCADE)
+    name = models.CharField(verbose_name=_('name'), max_length=100)
+    time_limit = models.PositiveIntegerField(verbose_name=_('time limit'), null=True, blank=True,
+                                             help_text=_('in minutes'))
+
+    state = models.CharField(verbose_name=_('state'), max_length=20, choices=state_choices, default=QUEUED)
+    error = models.TextField(verbose_name=_('error'), blank=True)
+    exercise = models.ForeignKey(verbose_name=_('exercise'), to=Exercise, null=True, blank=True,
+                                 on_delete=models.SET_NULL)
+
+    created = models.DateTimeField(verbose_name=_('created'), auto_now_add=True)
+    started = models.DateTimeField(verbose_name=_('started'), null=True, blank=True, editable=False)
+    updated = models.DateTimeField(verbose_name=_('updated'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('clone job')
+        verbose_name_plural = _('clone jobs')
+        ordering = ('-created',)
+
+    def __str__(self):
+        return _('{job.name}: {state}').format(job=self, state=self.get_state_display())
+
+    def is_pending(self):
+        return self.state in self.pending_states
+
+    def set_state(self, state: str, *, exercise: Exercise = None, error: str = None):
+        self.state = state
+        if exercise:
+            self.exercise = exercise
+        if error is not None:
+            self.error = error
+        self.save()
+
+        # Let the student know how it's going
+        redis_publisher = LabPublisher(facility='jobs', users=[self.student.get_username()])
+        redis_publisher.publish_message(RedisMessage(json.dumps({
+            'type': 'clone-job',
+            'job': self.id,
+            'state': self.state,
+            'state_display': str(self.get_state_display()),
+            'exercise': self.exercise_id,
+            'error': self.error,
+        })))
+
+
 class MonitorTemplate(models.Model):
     name = models.CharField(verbose_name=_('name'), unique=True, max_length=50)
     instructions = models.TextField(verbose_name=_('instructions'), blank=True,
@@ -353,9 +513,9 @@ class ExerciseNode(Node):
         verbose_name = _('exercise node')
         verbose_name_plural = _('exercise nodes')
 
-    def gns3_update_monitor_option(self, *, session: Session = None):
+    def gns3_update_monitor_option(self, *, session: GNS3Client = None):
         if not session:
-            session = get_gns3_session()
+            session = get_gns3_client()
 
         # This only applies to nodes linked to a monitor node
         if not isinstance(self.template_node, (MonitorNode, IRRNode)):
@@ -387,7 +547,7 @@ class ExerciseNode(Node):
 
     def gns3_start(self, *, session=None):
         if not session:
-            session = get_gns3_session()
+            session = get_gns3_client()
 
         project_base_url = gns3_base_url + '/v2/projects/' + str(self.project.gns3_id).lower()
         node_base_url = project_base_url + '/nodes/' + str(self.gns3_id).lower()
@@ -396,7 +556,7 @@ class ExerciseNode(Node):
 
     def gns3_stop(self, *, session=None):
         if not session:
-            session = get_gns3_session()
+            session = get_gns3_client()
 
         project_base_url = gns3_base_url + '/v2/projects/' + str(self.project.gns3_id).lower()
         node_base_url = project_base_url + '/nodes/' + str(self.gns3_id).lower()
@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext as _
+from requests import RequestException
+from ws4redis.redis_store import RedisMessage
+
+from generic.utils import print_debug, print_error, print_notice, print_warning
+from generic.websocket import LabPublisher
+from lab.models import Exercise, Project
+from lab.utils import get_gns3_projects
+from lab.utils.diagram import LAYOUT_TTL, topology_changed_key
+from lab.utils.gns3 import GNS3Client, gns3_base_url, gns3_nodes_key, store_gns3_nodes
+
+# How long the snapshot stays valid without hearing from the GNS3 server
+SNAPSHOT_TTL = 30
+
+# GNS3 sends a ping every few seconds, so a silent stream means we lost the connection
+READ_TIMEOUT = 30
+
+# How often to look for projects being opened or closed
+RESYNC_INTERVAL = 10
+
+
+class ProjectWatcher(threading.Thread):
+    """
+    Follows the notification stream of one GNS3 project and keeps the node snapshot of that project in the cache
+    """
+
+    def __init__(self, project_id: str, exercise_id: int = None, base_url: str = gns3_base_url):
+        super().__init__(name='gns3-' + project_id, daemon=True)
+        self.project_id = project_id
+        self.exercise_id = exercise_id
+        self.base_url = base_url + '/v2/projects/' + project_id
+
+        # Streams stay open forever, so don't let them take connections from the shared pool
+        self.session = GNS3Client()
+
+        self.nodes = {}
+        self.last_store = 0
+        self.response = None
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        if self.response is not None:
+            self.response.close()
+
+    def store(self):
+        store_gns3_nodes(self.project_id, list(self.nodes.values()), SNAPSHOT_TTL)
+        self.last_store = time.time()
+
+    def publish_status(self, node: dict):
+        if not self.exercise_id:
+            return
+
+        redis_publisher = LabPublisher(facility='{}/events'.format(self.exercise_id), broadcast=True)
+        redis_publisher.publish_message(RedisMessage(json.dumps({
+            'type': 'node-status',
+            'node_id': node['node_id'],
+            'status': node['status'],
+        })))
+
+    def handle(self, notification: dict):
+        action = notification.get('action')
+        event = notification.get('event') or {}
+
+        if action in ('node.created', 'node.updated'):
+            node_id = event['node_id'].lower()
+            old_node = self.nodes.get(node_id, {})
+            node = {**old_node, **event}
+            self.nodes[node_id] = node
+            self.store()
+
+            if old_node.get('status') != node.get('status'):
+                self.publish_status(node)
+
+        elif action == 'node.deleted':
+            self.nodes.pop(event['node_id'].lower(), None)
+            self.store()
+
+        elif action in ('link.created', 'link.updated', 'link.deleted',
+                        'drawing.created', 'drawing.updated', 'drawing.deleted'):
+            # Let sync_projects rebuild the diagram
+            cache.set(topology_changed_key(self.project_id), True, LAYOUT_TTL)
+
+        elif action == 'project.closed':
+            # Nothing to watch anymore, go back to polling
+            print_debug(_("Project {} closed").format(self.project_id))
+            cache.delete(gns3_nodes_key(self.project_id))
+            self.stopped.set()
+
+        elif time.time() - self.last_store > SNAPSHOT_TTL / 3:
+            # Pings and other notifications tell us the snapshot is still accurate
+            self.store()
+
+    def follow(self):
+        self.response = self.session.get(self.base_url + '/notifications', stream=True,
+                                         timeout=(self.session.timeout[0], READ_TIMEOUT))
+        with self.response:
+            # Take the snapshot after subscribing, so no change can slip through in between
+            server_nodes = self.session.get(self.base_url + '/nodes').json()
+            self.nodes = {node['node_id'].lower(): node for node in server_nodes}
+            self.store()
+
+            for line in self.response.iter_lines():
+                if self.stopped.is_set():
+                    return
+
+                if line:
+                    self.handle(json.loads(line))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.follow()
+            except (RequestException, ValueError) as e:
+                if self.stopped.is_set():
+                    break
+
+                print_warning(_("Lost notifications of project {project}: {error}").format(project=self.project_id,
+                                                                                          error=e))
+                self.stopped.wait(5)
+            except Exception as e:
+                print_error(_('Unexpected error: {}').format(e))
+                self.stopped.wait(5)
+
+
+def sync_watchers(watchers: dict):
+    # Only follow projects that we know, and that the server has opened
+    known_projects = {str(gns3_id).lower(): None for gns3_id in Project.objects.values_list('gns3_id', flat=True)}
+    known_projects.update({str(gns3_id).lower(): exercise_id for gns3_id, exercise_id in
+                           Exercise.objects.values_list('gns3_id', 'id')})
+
+    wanted = {}
+    for server_project in get_gns3_projects():
+        project_id = server_project['project_id'].lower()
+        if server_project.get('status') == 'opened' and project_id in known_projects:
+            wanted[project_id] = known_projects[project_id]
+
+    for project_id in list(watchers.keys()):
+        if project_id not in wanted or not watchers[project_id].is_alive():
+            watchers.pop(project_id).stop()
+
+    for project_id, exercise_id in wanted.items():
+        if project_id not in watchers:
+            watcher = ProjectWatcher(project_id, exercise_id)
+            watcher.start()
+            watchers[project_id] = watcher
+
+
+def run(run_once=False):
+    print_notice(_("Following GNS3 notifications from {hostname}:{port}").format(hostname=settings.GNS3['HOST'],
+                                                                                port=settings.GNS3['PORT']))
+
+    watchers = {}
+    while True:
+        try:
+            sync_watchers(watchers)
+        except RequestException as e:
+            print_warning(_("Cannot connect to GNS3 server: {}").format(e))
+        except Exception as e:
+            print_error(_('Unexpected error: {}').format(e))
+
+        if run_once:
+            return watchers
+
+        time.sleep(RESYNC_INTERVAL)
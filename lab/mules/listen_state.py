@@ -1,11 +1,18 @@
+import hashlib
 import json
+import multiprocessing
+import os
 import re
-import select
+import selectors
 import socket
+import time
+from traceback import print_exc
 
+from django import db
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.transaction import atomic
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from redis import StrictRedis
 from ws4redis import settings as private_settings
@@ -13,61 +20,316 @@ from ws4redis.redis_store import RedisMessage
 
 from generic.utils import print_debug, print_error, print_message, print_notice, print_warning
 from generic.websocket import LabPublisher
-from lab.models import ExerciseNode, ExerciseState, IRRNode, irr_goal_types, monitor_goal_types
+from lab.models import ExerciseNode, ExerciseState, irr_goal_types, monitor_goal_types
+from lab.utils.directory import NodeDirectory
 
 channel_pattern = re.compile(rb'^server:(\d+)/events$')
 
+# Markers for the sockets that aren't state connections
+LISTEN = 'listen'
+REDIS = 'redis'
+
+# Redis hash of "exercise id:node id" -> number of the shard that has the connection of that node
+REGISTRY_KEY = 'state_collector_routes'
+
+# Redis key that exists as long as a shard is alive, so the routes of a shard that died are ignored
+HEARTBEAT_KEY = 'state_collector_shard_{}'
+HEARTBEAT_TTL = 30
+
+
+class StateStore:
+    """
+    Remember a digest of the latest state of every goal, and write the changes to the database in batches
+    """
+
+    def __init__(self, flush_interval: float = 2, resend_interval: float = 30):
+        self.flush_interval = flush_interval
+        self.resend_interval = resend_interval
+        self.next_flush = time.monotonic() + flush_interval
+
+        # (exercise node id, goal type) -> (content digest, last update, moment it was last forwarded)
+        self.known = {}
+        self.pending = {}
+
+        self.received = 0
+        self.forwarded = 0
+        self.suppressed = 0
+        self.written = 0
+
+    @staticmethod
+    def digest(content: str) -> bytes:
+        return hashlib.sha1(content.encode('utf-8')).digest()
+
+    def load(self):
+        # Start with what the database already knows
+        states = ExerciseState.objects.values_list('exercise_node_id', 'goal_type', 'state', 'last_update')
+        for node_id, goal_type, content, last_update in states.iterator():
+            self.known[(node_id, goal_type)] = (self.digest(content), last_update, 0)
+
+    def update(self, node_id: int, goal_type: str, content: str):
+        """
+        Record a state, returns whether it should be forwarded and the moment it last changed
+        """
+        self.received += 1
+        now = time.monotonic()
+
+        key = (node_id, goal_type)
+        digest = self.digest(content)
+        known = self.known.get(key)
+        if known and known[0] == digest:
+            # Pages loaded before the next flush read the old state from the database, and the unchanged
+            # reports are the only way for them to catch up
+            if key not in self.pending and now - known[2] < self.resend_interval:
+                # Monitors keep sending the same report, nothing to write or tell
+                self.suppressed += 1
+                return False, known[1]
+
+            self.forwarded += 1
+            self.known[key] = (digest, known[1], now)
+            return True, known[1]
+
+        self.forwarded += 1
+        last_update = timezone.now()
+        self.known[key] = (digest, last_update, now)
+        self.pending[key] = (content, last_update)
+        return True, last_update
+
+    def forget_node(self, node_id: int):
+        # The node was deleted, or another shard may have stored its states
+        for key in [key for key in self.known if key[0] == node_id]:
+            del self.known[key]
+
+    def timeout(self):
+        return max(self.next_flush - time.monotonic(), 0)
+
+    @atomic
+    def write(self, pending: dict):
+        # Nodes may have been deleted in the meantime
+        node_ids = set(ExerciseNode.objects
+                       .filter(id__in={node_id for node_id, goal_type in pending})
+                       .values_list('id', flat=True))
+        for node_id in {node_id for node_id, goal_type in pending} - node_ids:
+            self.forget_node(node_id)
+        pending = {key: value for key, value in pending.items() if key[0] in node_ids}
+
+        existing = ExerciseState.objects \
+            .filter(exercise_node_id__in=node_ids, goal_type__in={goal_type for node_id, goal_type in pending})
+        existing = {(state.exercise_node_id, state.goal_type): state for state in existing}
+
+        changed = []
+        new = []
+        for (node_id, goal_type), (content, last_update) in pending.items():
+            state = existing.get((node_id, goal_type))
+            if state:
+                state.state = content
+                state.last_update = last_update
+                changed.append(state)
+            else:
+                new.append(ExerciseState(exercise_node_id=node_id, goal_type=goal_type, state=content,
+                                         last_update=last_update))
+
+        ExerciseState.objects.bulk_update(changed, ['state', 'last_update'], batch_size=500)
+        ExerciseState.objects.bulk_create(new, batch_size=500, ignore_conflicts=True)
+        return len(pending)
+
+    def flush(self, force=False):
+        if not force and time.monotonic() < self.next_flush:
+            return
+
+        self.next_flush = time.monotonic() + self.flush_interval
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        try:
+            self.written += self.write(pending)
+        except Exception as e:
+            print_exc()
+            print_error(e)
+
+            # Try again next time, unless newer states arrived in the meantime
+            for key, value in pending.items():
+                self.pending.setdefault(key, value)
+
+
+def publish_response(exercise_id: int, node_id: int, request_type: str, response: str):
+    redis_publisher = LabPublisher(facility='{}/events'.format(exercise_id), broadcast=True)
+    redis_publisher.publish_message(RedisMessage(json.dumps({
+        'type': request_type + '-response',
+        'node': node_id,
+        'response': response,
+    }, cls=DjangoJSONEncoder)))
+
+
+class ShardRoutes:
+    """
+    The state connections of this shard by (exercise id, node id), and which shard has the other connections
+    """
+
+    def __init__(self, shard: int = 0, redis: StrictRedis = None):
+        self.shard = shard
+        self.redis = redis
+        self.connections = {}
+        self.next_heartbeat = 0
+
+    @staticmethod
+    def field(key: tuple) -> str:
+        return '{}:{}'.format(*key)
+
+    def add(self, key: tuple, state_connection):
+        self.connections[key] = state_connection
+        if self.redis:
+            self.redis.hset(REGISTRY_KEY, self.field(key), self.shard)
+
+    def remove(self, key: tuple, state_connection):
+        if self.connections.get(key) is not state_connection:
+            return
+
+        del self.connections[key]
+        if self.redis and self.owner(key) == self.shard:
+            # Unless the node already reconnected to another shard
+            self.redis.hdel(REGISTRY_KEY, self.field(key))
+
+    def get(self, key: tuple):
+        return self.connections.get(key)
+
+    def owner(self, key: tuple):
+        if key in self.connections:
+            return self.shard
+
+        if not self.redis:
+            return None
+
+        shard = self.redis.hget(REGISTRY_KEY, self.field(key))
+        if shard is None or not self.redis.exists(HEARTBEAT_KEY.format(int(shard))):
+            return None
+
+        return int(shard)
+
+    def heartbeat(self):
+        now = time.monotonic()
+        if not self.redis or now < self.next_heartbeat:
+            return
+
+        self.redis.set(HEARTBEAT_KEY.format(self.shard), 1, ex=HEARTBEAT_TTL)
+        self.next_heartbeat = now + HEARTBEAT_TTL / 3
+
+    def clear(self):
+        # The shard stops, its connections go with it
+        if not self.redis:
+            return
+
+        fields = [field for field, shard in self.redis.hgetall(REGISTRY_KEY).items() if int(shard) == self.shard]
+        if fields:
+            self.redis.hdel(REGISTRY_KEY, *fields)
+        self.redis.delete(HEARTBEAT_KEY.format(self.shard))
+
+    def __len__(self):
+        return len(self.connections)
+
 
 class StateConnection:
     header = re.compile(r'^\*\*\*\*\*\[ +(.*?) +\]\*\*\*\*\*$')
+    header_start = b'*****['
+
+    # Route tables can be big, so read them in big chunks
+    recv_size = 65536
 
-    def __init__(self, connection: socket.socket):
+    def __init__(self, connection: socket.socket, address=None, store: StateStore = None,
+                 directory: NodeDirectory = None, routes: ShardRoutes = None,
+                 selector: selectors.BaseSelector = None, connections: set = None):
         self.connection = connection
-        self.buffer = ''
+        self.address = address
+        self.selector = selector
+        self.connections = connections
+        self.dropped = False
+        self.store = store or StateStore()
+        self.directory = directory or NodeDirectory()
+        self.routes = routes if routes is not None else ShardRoutes()
         self.uuid = None
         self.node = None
 
+        # Raw data, where to look for the next newline, where the current line starts, and where the content of the
+        # current section starts
+        self.buffer = bytearray()
+        self.scan_position = 0
+        self.line_start = 0
+        self.section_start = 0
+
         self.current_section_name = None
         self.current_section = ''
 
+        # What the monitor hasn't accepted yet, commands that would take more than the high-water mark are refused
+        self.outbound = bytearray()
+        self.high_water = settings.STATE_COLLECTOR.get('SEND_HIGH_WATER', 1048576)
+
+        # Whether the selector tells us when the monitor can take more
+        self.writing = False
+
     def collect_data(self):
-        data = self.connection.recv(1024)
+        data = self.connection.recv(self.recv_size)
         if not data:
             # The end
             return False
 
-        self.buffer += data.decode('utf-8')
+        self.buffer += data
+        self.parse()
+        return True
 
+    def decode_section(self, end: int) -> str:
+        # Decode the whole section at once, now that all its bytes are here
+        with memoryview(self.buffer) as view, view[self.section_start:end] as section:
+            text = str(section, 'utf-8', 'replace')
+
+        return ''.join(line.rstrip() + '\n' for line in text.split('\n')[:-1])
+
+    def parse(self):
+        buffer = self.buffer
         while True:
-            parts = self.buffer.split('\n', 1)
-            if len(parts) == 1:
-                # No newline, still building a line, done for now
-                return True
+            newline = buffer.find(b'\n', self.scan_position)
+            if newline < 0:
+                # Still building a line, continue from here when more data arrives
+                self.scan_position = len(buffer)
+                break
+
+            line_start = self.line_start
+            self.line_start = self.scan_position = newline + 1
 
-            # We have a line! Store remainder and process the line
-            line = parts[0].rstrip()
-            self.buffer = parts[1]
+            # Only section headers need a closer look, everything else is content
+            if not buffer.startswith(self.header_start, line_start):
+                continue
 
-            # Check if a new section begins
+            line = buffer[line_start:newline].decode('utf-8', 'replace').rstrip()
             match = self.header.match(line)
-            if match:
-                # First submit the previous section, if any
-                self.submit()
-
-                name = match.group(1)
-                if self.node and name == 'END':
-                    print_debug(_('Submitted {node.name} state of {exercise.name}').format(section=name, node=self.node,
-                                                                                           exercise=self.node.project))
-                    self.current_section_name = None
-                else:
-                    self.current_section_name = name
-
-                self.current_section = ''
+            if not match:
+                continue
+
+            # First submit the previous section, if any
+            if self.current_section_name:
+                self.current_section = self.decode_section(line_start)
+            self.submit()
+
+            name = match.group(1)
+            if self.node and name == 'END':
+                print_debug(_('Submitted {node.name} state of {node.project_name}').format(node=self.node))
+                self.current_section_name = None
             else:
-                # Not a section start, so add to current section
-                self.current_section += line + '\n'
+                self.current_section_name = name
+
+            self.current_section = ''
+            self.section_start = self.line_start
+
+        if not self.current_section_name:
+            # Content outside of a section is ignored anyway
+            self.section_start = self.line_start
+
+        # Forget what has been processed
+        if self.section_start:
+            del buffer[:self.section_start]
+            self.scan_position -= self.section_start
+            self.line_start -= self.section_start
+            self.section_start = 0
 
-    @atomic
     def submit(self):
         # Remember
         name = self.current_section_name
@@ -91,154 +353,366 @@ class StateConnection:
             return
 
         if not self.node:
-            try:
-                self.node = ExerciseNode.objects.get(gns3_id=self.uuid)
-            except ExerciseNode.DoesNotExist:
+            self.node = self.directory.get_by_uuid(self.uuid)
+            if not self.node:
                 print_error(_('Unable to submit {section} of {uuid}').format(section=name, uuid=self.uuid))
                 return
 
-        if name in monitor_goal_types or name in irr_goal_types:
-            state, created = ExerciseState.objects.select_for_update().get_or_create(defaults={
-                'state': content,
-            }, exercise_node=self.node, goal_type=name)
+            # From now on messages for this node come to us
+            self.routes.add((self.node.project_id, self.node.id), self)
 
-            if state.state != content:
-                # State changed
-                state.state = content
-                state.save()
+            if self.routes.redis:
+                # Other shards may have seen newer states of this node than we loaded at startup
+                self.store.forget_node(self.node.id)
 
-            redis_publisher = LabPublisher(facility='{}/events'.format(self.node.project_id), broadcast=True)
-            redis_publisher.publish_message(RedisMessage(json.dumps({
+        if name in monitor_goal_types or name in irr_goal_types:
+            # Written to the database later, together with the states of other nodes
+            changed, last_update = self.store.update(self.node.id, name, content)
+            if not changed:
+                return
+
+            self.publish({
                 'type': 'state',
                 'goal_type': name,
                 'node': self.node.id,
                 'content': content,
-                'ts': state.last_update,
-            }, cls=DjangoJSONEncoder)))
+                'ts': last_update,
+            })
         elif name in ['QUERY-RESULT', 'UPDATE-RESULT']:
-            redis_publisher = LabPublisher(facility='{}/events'.format(self.node.project_id), broadcast=True)
-            redis_publisher.publish_message(RedisMessage(json.dumps({
+            self.publish({
                 'type': 'irr-query-response' if name == 'QUERY-RESULT' else 'irr-update-response',
                 'node': self.node.id,
                 'request': 'irr-query' if name == 'QUERY-RESULT' else 'irr-update',
                 'response': content,
-            }, cls=DjangoJSONEncoder)))
+            })
 
         elif name != 'UUID':
             print_error(_("Unknown section name: [{}] from {}").format(name, self.uuid))
 
+    def publish(self, message: dict):
+        redis_publisher = LabPublisher(facility='{}/events'.format(self.node.project_id), broadcast=True)
+        redis_publisher.publish_message(RedisMessage(json.dumps(message, cls=DjangoJSONEncoder)))
+
     def send_message(self, data):
         # We only know how to send messages to IIR nodes
-        if not self.node or not isinstance(self.node.template_node, IRRNode):
+        if not self.node or self.node.kind != 'IRRNode':
             return
 
         if data['type'] == 'irr-query':
-            self.connection.send(b"*****[ QUERY ]*****\n")
-            self.connection.send(data['query'].encode() + b'\n')
-            self.connection.send(b"*****[ END ]*****\n")
-
+            frame = b"*****[ QUERY ]*****\n" + data['query'].encode() + b"\n*****[ END ]*****\n"
         elif data['type'] == 'irr-update':
-            self.connection.send(b"*****[ UPDATE ]*****\n")
-            self.connection.send(data['update'].encode() + b'\n')
-            self.connection.send(b"*****[ END ]*****\n")
+            frame = b"*****[ UPDATE ]*****\n" + data['update'].encode() + b"\n*****[ END ]*****\n"
+        else:
+            return
+
+        if self.outbound and len(self.outbound) + len(frame) > self.high_water:
+            # Rather tell the user than lose part of the command
+            print_warning(_("Send buffer of {uuid} is full, refusing {type}").format(uuid=self.uuid, type=data['type']))
+            publish_response(self.node.project_id, self.node.id, data['type'],
+                             'The server is still busy with previous requests, please try again later')
+            return
+
+        self.queue(frame)
+
+    def queue(self, data: bytes):
+        self.outbound += data
+        self.send_data()
+
+    def send_data(self):
+        if self.dropped:
+            return
+
+        try:
+            sent = self.connection.send(self.outbound)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            # The monitor went away, which only concerns this connection
+            print_warning(_("Lost state connection from {addr}: {error}").format(addr=self.address, error=e))
+            self.drop()
+            return
+
+        # Cheap, bytearrays are consumed from the front without moving the rest
+        del self.outbound[:sent]
+
+        # Only bother the selector when there starts or stops being something to send
+        writing = bool(self.outbound)
+        if self.selector and writing != self.writing:
+            self.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self.selector.modify(self.connection, events, self)
 
     def fileno(self):
         return self.connection.fileno()
 
+    def drop(self):
+        """
+        Stop watching the connection and close it
+        """
+        if self.dropped:
+            return
+
+        self.dropped = True
+        if self.selector:
+            self.selector.unregister(self.connection)
+        if self.connections is not None:
+            self.connections.discard(self)
+        self.close()
+
     def close(self):
+        if self.node:
+            self.routes.remove((self.node.project_id, self.node.id), self)
+
         return self.connection.close()
 
 
-def run():
+class CollectorMetrics:
+    """
+    Keep track of how the collector is doing, and report it every once in a while
+    """
+
+    def __init__(self, interval: float = 60, name: str = 'State collector'):
+        self.interval = interval
+        self.name = name
+        self.next_report = time.monotonic() + interval
+        self.max_lag = 0.0
+        self.redis_messages = 0
+        self.wakeups = 0
+
+    def timeout(self):
+        return max(self.next_report - time.monotonic(), 0)
+
+    def handled(self, started: float, redis_messages: int):
+        # How long the loop was busy with this wakeup, which delays everything else
+        self.max_lag = max(self.max_lag, time.monotonic() - started)
+        self.redis_messages += redis_messages
+        self.wakeups += 1
+
+    def report(self, connections: set, store: StateStore):
+        now = time.monotonic()
+        if now < self.next_report:
+            return
+
+        # Being late for the report is loop lag as well
+        self.max_lag = max(self.max_lag, now - self.next_report)
+
+        identified = len([connection for connection in connections if connection.node])
+        print_debug(_("{name}: {connections} connections ({identified} identified), {wakeups} wakeups, "
+                      "{messages} Redis messages, max loop lag {lag:.1f}ms").format(name=self.name,
+                                                                                     connections=len(connections),
+                                                                                     identified=identified,
+                                                                                     wakeups=self.wakeups,
+                                                                                     messages=self.redis_messages,
+                                                                                     lag=self.max_lag * 1000))
+        print_debug(_("{name}: {received} states received, {forwarded} forwarded, {suppressed} suppressed "
+                      "as unchanged, {written} written to the database").format(name=self.name,
+                                                                                received=store.received,
+                                                                                forwarded=store.forwarded,
+                                                                                suppressed=store.suppressed,
+                                                                                written=store.written))
+        store.received = 0
+        store.forwarded = 0
+        store.suppressed = 0
+        store.written = 0
+
+        self.next_report = now + self.interval
+        self.max_lag = 0.0
+        self.redis_messages = 0
+        self.wakeups = 0
+
+
+def accept_connection(listen_sock: socket.socket, selector: selectors.BaseSelector, connections: set,
+                      store: StateStore, directory: NodeDirectory, routes: ShardRoutes):
+    connection, client_address = listen_sock.accept()
+    print_message("Incoming state connection from {addr}".format(addr=client_address))
+    connection.setblocking(False)
+
+    state_connection = StateConnection(connection, client_address, store, directory, routes, selector, connections)
+    selector.register(connection, selectors.EVENT_READ, state_connection)
+    connections.add(state_connection)
+
+    # Ask for ID
+    state_connection.queue(b"*****[ ID ]*****\n*****[ END ]*****\n")
+
+
+def handle_redis_message(message: dict, routes: ShardRoutes):
+    # Data from websocket to the monitor
+    if message['type'] != 'pmessage':
+        return
+
+    match = channel_pattern.match(message['channel'])
+    if not match:
+        print_warning(_("Malformed channel name: {}").format(message['channel']))
+        return
+
+    exercise_id = int(match.group(1))
+    data = json.loads(message['data'])
+    if 'type' not in data or 'node_id' not in data:
+        print_warning(_("Malformed terminal input: {}").format(message['data']))
+        return
+
+    if data['type'] not in ['irr-query', 'irr-update']:
+        # Not for us
+        return
+
+    node_id = int(data['node_id'])
+
+    # Find the connection belonging to this exercise node
+    sc = routes.get((exercise_id, node_id))
+    if not sc:
+        # Every shard sees every command, the shard that has the connection handles it, and the first shard answers
+        # when nobody has it
+        if routes.shard != 0 or routes.owner((exercise_id, node_id)) is not None:
+            return
+
+        print_warning(_("No existing connection found for exercise {exercise} node {node}")
+                      .format(exercise=exercise_id, node=node_id))
+
+        publish_response(exercise_id, node_id, data['type'], 'Server is not yet available')
+        return
+
+    sc.send_message(data)
+
+
+def drain_redis(subscriber, routes: ShardRoutes) -> int:
+    # Handle everything that is waiting, including messages the parser already buffered
+    count = 0
+    while True:
+        message = subscriber.get_message(timeout=0)
+        if message is None:
+            return count
+
+        count += 1
+        try:
+            handle_redis_message(message, routes)
+        except Exception as e:
+            print_exc()
+            print_error(e)
+
+
+def create_listen_socket(address: str, port: int, backlog: int = 1024, reuse_port: bool = False) -> socket.socket:
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every shard has its own socket on the same port, and the kernel spreads the connections over them
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listen_sock.setblocking(False)
+    listen_sock.bind((address, port))
+    listen_sock.listen(backlog)
+    return listen_sock
+
+
+def run_shard(shard: int, shards: int, parent_pid: int = None):
     try:
-        print_notice(_("Listening for state updates on {addr}:{port}").format(
+        print_notice(_("Listening for state updates on {addr}:{port} (shard {shard} of {shards})").format(
             addr=settings.STATE_COLLECTOR['ADDRESS'],
             port=settings.STATE_COLLECTOR['PORT'],
+            shard=shard + 1,
+            shards=shards,
         ))
 
-        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_sock.setblocking(False)
-        listen_sock.bind((settings.STATE_COLLECTOR['ADDRESS'], settings.STATE_COLLECTOR['PORT']))
-        listen_sock.listen(128)
+        listen_sock = create_listen_socket(settings.STATE_COLLECTOR['ADDRESS'], settings.STATE_COLLECTOR['PORT'],
+                                           settings.STATE_COLLECTOR.get('BACKLOG', 1024), reuse_port=shards > 1)
 
         redis = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
         subscriber = redis.pubsub()
         subscriber.psubscribe('server:*/events')
 
+        # epoll where available, so the cost of a wakeup doesn't depend on the number of connections
+        selector = selectors.DefaultSelector()
+        selector.register(listen_sock, selectors.EVENT_READ, LISTEN)
         # noinspection PyProtectedMember
-        redis_fd = subscriber.connection._sock.fileno()
-
-        sockets = [listen_sock, redis_fd]
-
-        while sockets:
-            readable, writable, exceptional = select.select(sockets, [], [])
-
-            for s in readable:
-                if s is listen_sock:
-                    connection, client_address = s.accept()
-                    print_message("Incoming state connection from {addr}".format(addr=client_address))
-                    connection.setblocking(False)
-                    sockets.append(StateConnection(connection))
-
-                    # Ask for ID
-                    connection.send(b"*****[ ID ]*****\n")
-                    connection.send(b"*****[ END ]*****\n")
-
-                    continue
-
-                if s is redis_fd:
-                    # Data from websocket to telnet
-                    message = subscriber.parse_response()
-                    msg_type = message.pop(0)
-                    if msg_type != b'pmessage':
+        selector.register(subscriber.connection._sock, selectors.EVENT_READ, REDIS)
+
+        connections = set()
+        store = StateStore(settings.STATE_COLLECTOR.get('FLUSH_INTERVAL', 2),
+                           settings.STATE_COLLECTOR.get('RESEND_INTERVAL', 30))
+        store.load()
+
+        # All exercise nodes in one go, instead of a query for every monitor that connects
+        directory = NodeDirectory()
+        directory.load()
+
+        # Which connection belongs to which exercise node, shared with the other shards through Redis
+        routes = ShardRoutes(shard, redis if shards > 1 else None)
+        routes.heartbeat()
+        metrics = CollectorMetrics(settings.STATE_COLLECTOR.get('METRICS_INTERVAL', 60),
+                                   'State collector {}'.format(shard + 1) if shards > 1 else 'State collector')
+
+        try:
+            while True:
+                events = selector.select(min(metrics.timeout(), store.timeout()))
+                started = time.monotonic()
+                redis_messages = 0
+
+                for key, mask in events:
+                    if key.data is LISTEN:
+                        try:
+                            accept_connection(listen_sock, selector, connections, store, directory, routes)
+                        except BlockingIOError:
+                            # Another shard was quicker
+                            pass
                         continue
 
-                    pattern, channel, message = message
-                    match = channel_pattern.match(channel)
-                    if not match:
-                        print_warning(_("Malformed channel name: {}").format(channel))
+                    if key.data is REDIS:
+                        redis_messages += drain_redis(subscriber, routes)
                         continue
 
-                    exercise_id = int(match.group(1))
-                    data = json.loads(message)
-                    if 'type' not in data or 'node_id' not in data:
-                        print_warning(_("Malformed terminal input: {}").format(message))
+                    sc = key.data
+                    if sc.dropped:
+                        # Earlier in this round
                         continue
 
-                    if data['type'] not in ['irr-query', 'irr-update']:
-                        # Not for us
-                        continue
+                    try:
+                        if mask & selectors.EVENT_WRITE:
+                            sc.send_data()
+                        if sc.dropped or not mask & selectors.EVENT_READ:
+                            continue
+                        result = sc.collect_data()
+                    except (OSError, UnicodeDecodeError) as e:
+                        print_warning(e)
+                        result = False
+
+                    if not result:
+                        # End of connection
+                        print_message("Lost state connection from {addr}".format(addr=sc.address))
+                        sc.drop()
+
+                if events:
+                    metrics.handled(started, redis_messages)
+                store.flush()
+                directory.refresh()
+                routes.heartbeat()
+                metrics.report(connections, store)
+
+                if parent_pid and os.getppid() != parent_pid:
+                    # The mule is gone, a new one will start its own shards
+                    return
+        finally:
+            # Don't lose what hasn't been written yet
+            store.flush(force=True)
 
-                    node_id = int(data['node_id'])
+            try:
+                routes.clear()
+            except Exception as e:
+                print_error(e)
 
-                    # Find the connection belonging to this exercise node
-                    for sc in sockets:
-                        if isinstance(sc, StateConnection) and sc.node and \
-                                sc.node.project_id == exercise_id and sc.node.id == node_id:
-                            break
-                    else:
-                        print_warning(_("No existing connection found for exercise {exercise} node {node}")
-                                      .format(exercise=exercise_id, node=node_id))
+    except Exception as e:
+        print_exc()
+        print_error(e)
 
-                        redis_publisher = LabPublisher(facility='{}/events'.format(exercise_id), broadcast=True)
-                        redis_publisher.publish_message(RedisMessage(json.dumps({
-                            'type': data['type'] + '-response',
-                            'node': node_id,
-                            'response': 'Server is not yet available',
-                        }, cls=DjangoJSONEncoder)))
 
-                        continue
+def run():
+    shards = max(settings.STATE_COLLECTOR.get('SHARDS', 1), 1)
+    if shards > 1:
+        # Nobody is connected to the new shards yet
+        StrictRedis(**private_settings.WS4REDIS_CONNECTION).delete(REGISTRY_KEY)
 
-                    sc.send_message(data)
-                    continue
+        # Don't share database connections with the children
+        db.connections.close_all()
 
-                result = s.collect_data()
-                if not result:
-                    # End of connection
-                    print_message("Lost state connection from {addr}".format(addr=s.connection.getpeername()))
-                    sockets.remove(s)
-                    s.close()
+        context = multiprocessing.get_context('fork')
+        for shard in range(1, shards):
+            context.Process(target=run_shard, args=(shard, shards, os.getpid()), daemon=True).start()
 
-    except Exception as e:
-        print_error(e)
+    run_shard(0, shards)
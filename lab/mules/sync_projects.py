@@ -9,26 +9,26 @@ from requests import RequestException
 
 from generic.utils import print_debug, print_message, print_notice, print_warning, print_error
 from lab.models import Exercise, ExerciseNode, Project
-from lab.utils import (get_gns3_nodes, get_gns3_projects)
-from lab.utils.gns3 import get_gns3_session, gns3_base_url
-
-session = get_gns3_session()
+from lab.utils.diagram import ProjectDiagram
+from lab.utils.gns3 import get_gns3_client, gns3_base_url
+from lab.utils.inventory import get_gns3_node_inventory, get_gns3_project_inventory
+from lab.utils.symbols import warm_symbols
 
 
 def sync_projects_to_db():
     print_debug("Synchronising projects")
 
+    session = get_gns3_client()
+
     # Detect projects on the server
-    server_projects = get_gns3_projects(session=session)
+    server_projects = get_gns3_project_inventory(session=session)
 
     # Sync projects
     projects = Project.objects.select_subclasses()
     for project in projects:
         try:
-            for server_project in server_projects:
-                if server_project['project_id'].lower() == str(project.gns3_id).lower():
-                    break
-            else:
+            server_project = server_projects.get(project.gns3_id)
+            if not server_project:
                 # Where did that one go?!?
                 print_warning("- " + _("Project {project.name} disappeared from GNS3 server").format(project=project))
                 # project.delete()
@@ -44,13 +44,11 @@ def sync_projects_to_db():
                 project.save()
 
             # Sync nodes
-            server_nodes = get_gns3_nodes(server_project['project_id'], session=session)
+            server_nodes = get_gns3_node_inventory(server_project['project_id'], session=session)
             nodes = project.node_set.select_subclasses()
             for node in nodes:
-                for server_node in server_nodes:
-                    if server_node['node_id'].lower() == str(node.gns3_id).lower():
-                        break
-                else:
+                server_node = server_nodes.get(node.gns3_id)
+                if not server_node:
                     # Where did that one go?!?
                     print_warning("- " + _("Node {node.name} of project {project.name} disappeared from GNS3 server")
                                   .format(node=node, project=project))
@@ -86,6 +84,10 @@ def sync_projects_to_db():
                     project.delete()
                     continue
 
+            # Keep the cached diagram in line with the topology in GNS3
+            if ProjectDiagram(project).refresh_layout(list(server_nodes), session=session):
+                print_debug("- " + _("Diagram of project {project.name} updated").format(project=project))
+
         except IntegrityError:
             print_error("  - " + _("Template is still referenced, leaving it for now"))
 
@@ -93,15 +95,25 @@ def sync_projects_to_db():
 def run(run_once=False):
     try:
         # Test reachability
+        session = get_gns3_client()
         data = session.get(gns3_base_url + '/v2/version').json()
         print_notice(_("Connected to {hostname}:{port} (GNS v{version})").format(hostname=settings.GNS3['HOST'],
                                                                                  port=settings.GNS3['PORT'],
                                                                                  version=data['version']))
 
         # Run
+        warmed = False
         while True:
             sync_projects_to_db()
 
+            if not warmed:
+                # All projects are open now, so we know which symbols they use
+                print_notice(_("{count} symbols in the symbol store").format(count=warm_symbols(session=session)))
+                warmed = True
+
+            print_debug(_("GNS3 connections: {new_connections} new, {reused_connections} reused "
+                          "for {requests} requests").format(**session.stats))
+
             if run_once:
                 return
 
@@ -1,147 +1,594 @@
+import asyncio
 import json
 import re
-import select
+import time
 from base64 import b64encode
-from telnetlib import Telnet
+from collections import OrderedDict
 from traceback import print_exc
+from typing import Optional, Tuple
 
+from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from redis import StrictRedis
 from ws4redis import settings as private_settings
 from ws4redis.redis_store import RedisMessage
 
-from generic.utils import print_error, print_notice, print_warning
+from generic.utils import print_debug, print_error, print_notice, print_warning
 from generic.websocket import LabPublisher
-from lab.models import ExerciseNode, IRRNode, WorkNode, monitor_goal_type_choices
+from lab.models import Exercise, ExerciseNode, IRRNode, WorkNode
 from lab.utils.gns3 import get_gns3_node
 
-goal_types = dict(monitor_goal_type_choices).keys()
-
 channel_pattern = re.compile(rb'^server:(\d+)/events$')
 
+# Telnet commands, see RFC 854
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+# Where the parser is in the telnet stream
+DATA = 0
+COMMAND = 1
+OPTION = 2
+SUBNEGOTIATION = 3
+SUBNEGOTIATION_COMMAND = 4
+
+
+class TelnetParser:
+    """
+    Separate console output from telnet commands as data arrives, refusing every option the console asks for
+    """
+
+    def __init__(self):
+        self.state = DATA
+        self.command = None
+
+    def feed(self, data: bytes) -> Tuple[bytes, bytes]:
+        """
+        Returns the console output in the data, and what to answer
+        """
+        output = bytearray()
+        replies = bytearray()
+
+        position = 0
+        length = len(data)
+        while position < length:
+            state = self.state
+            if state == DATA or state == SUBNEGOTIATION:
+                # Most of the stream is plain output, skip to the next command in one go
+                iac = data.find(b'\xff', position)
+                end = length if iac < 0 else iac
+                if state == DATA:
+                    output += data[position:end]
+                if iac < 0:
+                    break
+
+                position = iac + 1
+                self.state = COMMAND if state == DATA else SUBNEGOTIATION_COMMAND
+                continue
+
+            byte = data[position]
+            position += 1
+
+            if state == COMMAND:
+                if byte == IAC:
+                    # Escaped 0xff
+                    output.append(IAC)
+                    self.state = DATA
+                elif byte in (WILL, WONT, DO, DONT):
+                    self.command = byte
+                    self.state = OPTION
+                elif byte == SB:
+                    self.state = SUBNEGOTIATION
+                else:
+                    # NOP, GA and friends
+                    self.state = DATA
+
+            elif state == OPTION:
+                # Everything stays off, like telnetlib did
+                if self.command == WILL:
+                    replies += bytes((IAC, DONT, byte))
+                elif self.command == DO:
+                    replies += bytes((IAC, WONT, byte))
+                self.state = DATA
+
+            elif state == SUBNEGOTIATION_COMMAND:
+                self.state = DATA if byte == SE else SUBNEGOTIATION
+
+        # Telnetlib dropped these as well
+        return bytes(output).translate(None, b'\x00\x11'), bytes(replies)
+
+    @staticmethod
+    def escape(data: bytes) -> bytes:
+        return data.replace(b'\xff', b'\xff\xff')
+
+
+class OutputHistory:
+    """
+    The most recent output of a console, in a ring buffer that grows up to its capacity
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer = bytearray()
+
+        # Where the oldest byte is once the buffer is full
+        self.position = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def append(self, data: bytes):
+        if len(data) >= self.capacity:
+            self.buffer = bytearray(data[-self.capacity:])
+            self.position = 0
+            return
+
+        free = self.capacity - len(self.buffer)
+        if free:
+            self.buffer += data[:free]
+            data = data[free:]
+            if not data:
+                return
+
+        # Overwrite the oldest output
+        end = self.position + len(data)
+        if end <= self.capacity:
+            self.buffer[self.position:end] = data
+        else:
+            first = self.capacity - self.position
+            self.buffer[self.position:] = data[:first]
+            self.buffer[:len(data) - first] = data[first:]
+        self.position = end % self.capacity
+
+    def get(self) -> bytes:
+        return bytes(self.buffer[self.position:] + self.buffer[:self.position])
+
+
+class RelayMetrics:
+    """
+    Keep track of how much output the relay handles, and in how many messages
+    """
+
+    def __init__(self):
+        self.reset()
 
-class LabTelnet(Telnet):
-    def __init__(self, key, host, port):
-        super().__init__(host, port, 0.01)
+    def reset(self):
+        self.started = time.monotonic()
+        self.reads = 0
+        self.dropped_reads = 0
+        self.output_bytes = 0
+        self.messages = 0
+        self.message_bytes = 0
+
+    def read(self, size: int):
+        self.reads += 1
+        if size:
+            self.output_bytes += size
+        else:
+            # Only telnet negotiation, nothing to show
+            self.dropped_reads += 1
+
+    def published(self, size: int):
+        self.messages += 1
+        self.message_bytes += size
+
+    def report(self, sessions: dict, history_bytes: int = 0):
+        duration = max(time.monotonic() - self.started, 0.001)
+        print_debug(_("Telnet relay: {sessions} sessions ({paused} paused), {reads} reads ({dropped} without output), "
+                      "{messages} messages ({rate:.1f}/s), {per_message:.0f} bytes per message, "
+                      "{overhead:.0f}% overhead, {history} bytes of history")
+                    .format(sessions=len([session for session in sessions.values() if session]),
+                            paused=len([session for session in sessions.values()
+                                        if session and not session.viewed.is_set()]),
+                            reads=self.reads,
+                            dropped=self.dropped_reads,
+                            messages=self.messages,
+                            rate=self.messages / duration,
+                            per_message=self.message_bytes / max(self.messages, 1),
+                            overhead=(self.message_bytes / max(self.output_bytes, 1) - 1) * 100
+                            if self.output_bytes else 0,
+                            history=history_bytes))
+        self.reset()
+
+
+class ConsoleSession:
+    """
+    The telnet connection to the console of one exercise node
+    """
+
+    # Console output comes in small pieces anyway
+    read_size = 65536
+
+    def __init__(self, relay: 'TelnetRelay', key: tuple):
+        self.relay = relay
         self.key = key
+        self.parser = TelnetParser()
+        self.writer = None
+        self.task = None
 
+        # What the user typed before the connection was there
+        self.pending = bytearray()
 
-def run():
-    print_notice("Starting telnet relay")
+        # Output waiting to be published together
+        self.output = bytearray()
+        self.flush_handle = None
 
-    try:
+        # Without open terminals we stop reading, and the console has to wait until TCP lets it continue
+        self.viewed = asyncio.Event()
+        self.viewed.set()
+        self.last_viewed = time.monotonic()
+
+        # Input or output, an open terminal alone doesn't keep the console connected
+        self.last_activity = time.monotonic()
+
+    def seen(self):
+        # A terminal of this console is open
+        self.last_viewed = time.monotonic()
+        self.viewed.set()
+
+    def set_viewed(self, viewed: bool):
+        if viewed:
+            self.viewed.set()
+        else:
+            self.viewed.clear()
+
+    def write(self, data: bytes):
+        # Someone is typing, so someone is watching
+        self.last_activity = time.monotonic()
+        self.seen()
+
+        data = self.parser.escape(data)
+        if self.writer:
+            self.writer.write(data)
+        else:
+            self.pending += data
+
+    def add_output(self, data: bytes):
+        self.output += data
+        if len(self.output) >= self.relay.batch_size:
+            self.flush_output()
+        elif not self.flush_handle:
+            # Wait a moment for the rest of what the console is printing
+            self.flush_handle = asyncio.get_event_loop().call_later(self.relay.batch_delay, self.flush_output)
+
+    def flush_output(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.output:
+            output, self.output = bytes(self.output), bytearray()
+            self.relay.remember_output(self.key, output)
+            self.relay.publish_output(self.key, output)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        try:
+            # Finding the console means asking the database and GNS3, don't block the other sessions
+            console = await loop.run_in_executor(None, self.relay.find_console, *self.key)
+            if not console:
+                return
+
+            if console == 'ignore':
+                # We can only handle telnet consoles, put on the ignore list
+                self.relay.sessions[self.key] = None
+                return
+
+            host, port = console
+            try:
+                reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                                             self.relay.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                print_warning(_("Telnet connection to {} {} failed: {}").format(host, port, str(e) or 'timeout'))
+                return
+
+            print_notice(_("Telnet connection to {} {} established").format(host, port))
+            if self.pending:
+                self.writer.write(self.pending)
+                self.pending = bytearray()
+
+            while True:
+                if not self.viewed.is_set():
+                    await self.viewed.wait()
+
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+
+                output, replies = self.parser.feed(data)
+                if replies:
+                    self.writer.write(replies)
+
+                self.relay.metrics.read(len(output))
+                if output:
+                    self.last_activity = time.monotonic()
+                    self.add_output(output)
+
+            print_warning(_("Telnet connection to {} {} closed").format(host, port))
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print_exc()
+            print_error(e)
+
+        finally:
+            self.flush_output()
+            if self.writer:
+                self.writer.close()
+            if self.relay.sessions.get(self.key) is self:
+                del self.relay.sessions[self.key]
+
+
+class TelnetRelay:
+    """
+    Relay terminal input from Redis to the node consoles and their output back, one task per console
+    """
+
+    def __init__(self):
+        self.connect_timeout = settings.TELNET_RELAY.get('CONNECT_TIMEOUT', 5)
+
+        # Console output is published in batches, and in JSON or compact frames
+        self.batch_delay = settings.TELNET_RELAY.get('BATCH_DELAY', 0.005)
+        self.batch_size = settings.TELNET_RELAY.get('BATCH_SIZE', 16384)
+        self.frame_format = settings.TELNET_RELAY.get('FRAME_FORMAT', 'json')
+
+        # Recent output per console, least recently active first, for terminals that open later
+        self.history_size = settings.TELNET_RELAY.get('HISTORY_SIZE', 65536)
+        self.history_limit = settings.TELNET_RELAY.get('HISTORY_LIMIT', 67108864)
+        self.histories = OrderedDict()
+        self.history_bytes = 0
+
+        # Sessions without open terminals are paused, and sessions without input or output are closed after a while
+        self.viewer_interval = settings.TELNET_RELAY.get('VIEWER_INTERVAL', 5)
+        self.viewer_timeout = settings.TELNET_RELAY.get('VIEWER_TIMEOUT', 30)
+        self.idle_timeout = settings.TELNET_RELAY.get('IDLE_TIMEOUT', 1800)
+
+        self.metrics = RelayMetrics()
+        self.metrics_interval = settings.TELNET_RELAY.get('METRICS_INTERVAL', 60)
+
+        # (exercise id, node id) -> console session, or None if we can't relay this console
+        self.sessions = {}
+
+    @staticmethod
+    def find_console(exercise_id: int, node_id: int):
+        """
+        Returns the host and port of the console of a node, 'ignore' if it isn't telnet, or None if there is no node
+        """
+        nodes = list(ExerciseNode.objects
+                     .filter(project_id=exercise_id, id=node_id)
+                     .select_related('project'))
+        if not nodes or not isinstance(nodes[0].template_node, (WorkNode, IRRNode)):
+            print_warning(_("Invalid node-id {node_id} provided for exercise {exercise_id}")
+                          .format(node_id=node_id, exercise_id=exercise_id))
+            return None
+
+        node = nodes[0]
+        gns3_node = get_gns3_node(node.project.gns3_id, node.gns3_id)
+        if gns3_node['console_type'] != 'telnet':
+            return 'ignore'
+
+        if gns3_node['console_host'] == '::':
+            host = '::1'
+        elif gns3_node['console_host'] == '0.0.0.0':
+            host = '127.0.0.1'
+        else:
+            host = gns3_node['console_host']
+
+        return host, gns3_node['console']
+
+    def output_message(self, node_id: int, data: bytes) -> str:
+        if self.frame_format == 'compact':
+            # "t<node id>" and a newline, then the bytes as latin-1: websocket frames must be text, and this costs
+            # nothing for ASCII instead of the 33% of base64
+            return 't{}\n'.format(node_id) + data.decode('latin-1')
+
+        return json.dumps({
+            'type': 'terminal-output',
+            'node_id': node_id,
+            'data': b64encode(data).decode('ascii'),
+        })
+
+    def publish_output(self, key: tuple, data: bytes):
+        exercise_id, node_id = key
+        message = self.output_message(node_id, data)
+        self.metrics.published(len(message.encode('utf-8')))
+
+        redis_publisher = LabPublisher(facility='{}/events'.format(exercise_id), broadcast=True)
+        redis_publisher.publish_message(RedisMessage(message))
+
+    def remember_output(self, key: tuple, data: bytes):
+        if not self.history_size:
+            return
+
+        history = self.histories.get(key)
+        if history is None:
+            history = self.histories[key] = OutputHistory(self.history_size)
+        else:
+            self.histories.move_to_end(key)
+
+        size = len(history)
+        history.append(data)
+        self.history_bytes += len(history) - size
+
+        while self.history_bytes > self.history_limit:
+            # Forget the console that has been quiet the longest
+            oldest_key, oldest = self.histories.popitem(last=False)
+            self.history_bytes -= len(oldest)
+
+    def forget_history(self, key: tuple):
+        history = self.histories.pop(key, None)
+        if history is not None:
+            self.history_bytes -= len(history)
+
+    def publish_history(self, key: tuple, request):
+        exercise_id, node_id = key
+        history = self.histories.get(key)
+
+        session = self.sessions.get(key)
+        if session:
+            # A terminal just opened
+            session.seen()
+
+        # Only the terminal that asked knows the request, the others already have this output
+        redis_publisher = LabPublisher(facility='{}/events'.format(exercise_id), broadcast=True)
+        redis_publisher.publish_message(RedisMessage(json.dumps({
+            'type': 'terminal-history',
+            'node_id': node_id,
+            'request': request,
+            'data': b64encode(history.get() if history else b'').decode('ascii'),
+        })))
+
+    @staticmethod
+    def check_exercises(exercise_ids: list) -> set:
+        """
+        Returns which exercises still exist
+        """
+        return set(Exercise.objects.filter(id__in=exercise_ids).values_list('id', flat=True))
+
+    def close_session(self, key: tuple):
+        session = self.sessions.pop(key, None)
+        if session and session.task:
+            session.task.cancel()
+
+    def update_sessions(self, existing: set):
+        now = time.monotonic()
+        for key, session in list(self.sessions.items()):
+            exercise_id, node_id = key
+            if exercise_id not in existing:
+                print_notice(_("Exercise {} was deleted, closing the console of node {}").format(exercise_id, node_id))
+                self.close_session(key)
+                continue
+
+            if not session:
+                continue
+
+            # Every websocket of the exercise gets the broadcasts, only terminals say they are watching
+            session.set_viewed(now - session.last_viewed < self.viewer_timeout)
+            if now - session.last_activity > self.idle_timeout:
+                print_notice(_("Nobody used the console of node {} of exercise {} for a while, closing it")
+                             .format(node_id, exercise_id))
+                self.close_session(key)
+
+        for key in list(self.histories):
+            if key[0] not in existing:
+                self.forget_history(key)
+
+    async def watch_viewers(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.viewer_interval)
+
+            exercise_ids = list({key[0] for key in self.sessions} | {key[0] for key in self.histories})
+            if not exercise_ids:
+                continue
+
+            try:
+                # The database, don't block the consoles
+                existing = await loop.run_in_executor(None, self.check_exercises, exercise_ids)
+            except Exception as e:
+                print_exc()
+                print_error(e)
+                continue
+
+            self.update_sessions(existing)
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self.metrics.report(self.sessions, self.history_bytes)
+
+    def handle_input(self, key: tuple, data: bytes) -> Optional[ConsoleSession]:
+        if key in self.sessions:
+            session = self.sessions[key]
+            if session:
+                session.write(data)
+            return session
+
+        session = ConsoleSession(self, key)
+        session.write(data)
+        self.sessions[key] = session
+        session.task = asyncio.ensure_future(session.run())
+        return session
+
+    def handle_redis_message(self, message: dict):
+        # Data from websocket to telnet
+        if message['type'] != 'pmessage':
+            return
+
+        match = channel_pattern.match(message['channel'])
+        if not match:
+            print_warning(_("Malformed channel name: {}").format(message['channel']))
+            return
+
+        exercise_id = int(match.group(1))
+        data = json.loads(message['data'])
+        if 'type' not in data or 'node_id' not in data:
+            print_warning(_("Malformed terminal input: {}").format(message['data']))
+            return
+
+        if data['type'] == 'terminal-input':
+            self.handle_input((exercise_id, int(data['node_id'])), data['data'].encode())
+        elif data['type'] == 'terminal-history':
+            self.publish_history((exercise_id, int(data['node_id'])), data.get('request'))
+        elif data['type'] == 'terminal-viewing':
+            # Open terminals say so now and then, there is nothing to resume for consoles we aren't connected to
+            session = self.sessions.get((exercise_id, int(data['node_id'])))
+            if session:
+                session.seen()
+
+    def drain_redis(self, subscriber):
+        # Handle everything that is waiting, including messages the parser already buffered
+        while True:
+            message = subscriber.get_message(timeout=0)
+            if message is None:
+                return
+
+            try:
+                self.handle_redis_message(message)
+            except Exception as e:
+                print_exc()
+                print_error(e)
+
+    async def serve(self):
         redis = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
         subscriber = redis.pubsub()
         subscriber.psubscribe('server:*/events')
 
+        # Redis stays synchronous, we only read from it when it has something for us
+        loop = asyncio.get_event_loop()
         # noinspection PyProtectedMember
         redis_fd = subscriber.connection._sock.fileno()
-        sockets = [redis_fd]
-
-        sessions = {}
-
-        while sockets:
-            readable, writable, exceptional = select.select(sockets, [], [])
-            for s in readable:
-                if s is redis_fd:
-                    # Data from websocket to telnet
-                    message = subscriber.parse_response()
-                    msg_type = message.pop(0)
-                    if msg_type != b'pmessage':
-                        continue
-
-                    pattern, channel, message = message
-                    match = channel_pattern.match(channel)
-                    if not match:
-                        print_warning(_("Malformed channel name: {}").format(channel))
-                        continue
-
-                    exercise_id = int(match.group(1))
-                    data = json.loads(message)
-                    if 'type' not in data or 'node_id' not in data:
-                        print_warning(_("Malformed terminal input: {}").format(message))
-                        continue
-
-                    if data['type'] != 'terminal-input':
-                        # Not for us
-                        continue
-
-                    node_id = int(data['node_id'])
-
-                    key = (exercise_id, node_id)
-                    if key in sessions:
-                        session = sessions[key]
-                    else:
-                        nodes = list(ExerciseNode.objects
-                                     .filter(project_id=exercise_id, id=node_id)
-                                     .select_related('project'))
-                        if not nodes or not isinstance(nodes[0].template_node, (WorkNode, IRRNode)):
-                            print_warning(_("Invalid node-id {node_id} provided for exercise {exercise_id}")
-                                          .format(node_id=node_id, exercise_id=exercise_id))
-                        node = nodes[0]
-                        gns3_node = get_gns3_node(node.project.gns3_id, node.gns3_id)
-
-                        if gns3_node['console_type'] != 'telnet':
-                            # We can only handle telnet consoles, put on the ignore list
-                            sessions[key] = None
-                            continue
-
-                        if gns3_node['console_host'] == '::':
-                            host = '::1'
-                        elif gns3_node['console_host'] == '0.0.0.0':
-                            host = '127.0.0.1'
-                        else:
-                            host = gns3_node['console_host']
-
-                        port = gns3_node['console']
-
-                        try:
-                            session = LabTelnet(key, host, port)
-                            print_notice(_("Telnet connection to {} {} established").format(host, port))
-                        except ConnectionRefusedError:
-                            print_warning(_("Connection refused by {} {}").format(host, port))
-                            continue
-
-                        sockets.append(session)
-                        sessions[key] = session
-
-                    # If there is no session then ignore the data
-                    if not session:
-                        continue
-
-                    # Write the data to the session
-                    try:
-                        session.write(data['data'].encode())
-                    except EOFError:
-                        # Connection closed, clean up
-                        print_warning(_("Telnet connection to {} {} closed").format(session.host, session.port))
-                        sockets.remove(s)
-                        del sessions[s.key]
-                    except (OSError, IOError) as e:
-                        print_exc()
-                        print_error(e)
+        lost = loop.create_future()
 
-                else:
-                    # Data from telnet to websocket
-                    exercise_id, node_id = s.key
-                    try:
-                        data = s.read_eager()
-
-                        redis_publisher = LabPublisher(facility='{}/events'.format(exercise_id), broadcast=True)
-                        redis_publisher.publish_message(RedisMessage(json.dumps({
-                            'type': 'terminal-output',
-                            'node_id': node_id,
-                            'data': b64encode(data).decode('ascii'),
-                        })))
-
-                    except EOFError:
-                        # Connection closed, clean up
-                        print_warning(_("Telnet connection to {} {} closed").format(s.host, s.port))
-                        sockets.remove(s)
-                        del sessions[s.key]
-                    except (OSError, IOError) as e:
-                        print_exc()
-                        print_error(e)
+        def redis_readable():
+            try:
+                self.drain_redis(subscriber)
+            except Exception as e:
+                # Without Redis there is nothing to relay
+                loop.remove_reader(redis_fd)
+                lost.set_exception(e)
+
+        loop.add_reader(redis_fd, redis_readable)
+        tasks = [asyncio.ensure_future(self.report_metrics()), asyncio.ensure_future(self.watch_viewers())]
+        try:
+            await lost
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def run():
+    print_notice("Starting telnet relay")
+
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(TelnetRelay().serve())
 
     except Exception as e:
         print_exc()
@@ -0,0 +1,48 @@
+import time
+from traceback import print_exc
+
+from django.db.models import Count, Q
+from django.utils.translation import gettext as _
+
+from generic.utils import print_debug, print_error, print_notice
+from lab.models import Exercise, Template
+
+
+def refill_pools():
+    templates = Template.objects.annotate(pooled=Count('exercise', filter=Q(exercise__student__isnull=True)))
+    for template in templates.filter(Q(warm_pool_size__gt=0) | Q(pooled__gt=0)):
+        if template.pooled > template.warm_pool_size:
+            # The pool was made smaller
+            surplus = Exercise.objects.filter(based_on=template, student__isnull=True).order_by('-id')
+            for exercise in surplus[:template.pooled - template.warm_pool_size]:
+                print_notice(_("Removing {exercise} from the pool").format(exercise=exercise.name))
+                exercise.delete()
+            continue
+
+        missing = min(template.warm_pool_size - template.pooled, template.warm_pool_refill_rate)
+        for _i in range(missing):
+            try:
+                exercise = template.fill_pool()
+                print_notice(_("Added {exercise} to the pool").format(exercise=exercise.name))
+            except Exception as e:
+                print_exc()
+                print_error(_("Unable to fill the pool of {template}: {error}").format(template=template.name,
+                                                                                      error=e))
+                break
+
+
+def run(run_once=False):
+    print_notice(_("Maintaining warm exercise pools"))
+
+    while True:
+        try:
+            print_debug(_("Refilling pools"))
+            refill_pools()
+        except Exception as e:
+            print_error(_('Unexpected error: {}').format(e))
+
+        if run_once:
+            return
+
+        # The refill rate is per minute
+        time.sleep(60)
@@ -1,10 +1,21 @@
-from django.db.models.signals import pre_delete
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
-from lab.models import Exercise
+from lab.models import Exercise, ExerciseNode
+from lab.utils.directory import bump_node_directory
 
 
 # noinspection PyUnusedLocal
 @receiver(signal=pre_delete, sender=Exercise)
 def delete_gns3(sender, instance: Exercise, **_kwargs):
     instance.gns3_delete()
+
+
+# noinspection PyUnusedLocal
+@receiver(signal=post_save, sender=ExerciseNode)
+@receiver(signal=post_delete, sender=ExerciseNode)
+def exercise_nodes_changed(sender, instance: ExerciseNode, created=True, **_kwargs):
+    if created:
+        # Readers that see the new version must also see the nodes, which they don't before the commit
+        transaction.on_commit(bump_node_directory)
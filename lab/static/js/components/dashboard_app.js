@@ -6,7 +6,7 @@ import {bindActionCreators} from 'redux';
 import Sockette from "sockette";
 
 import '../../css/dashboard-app.css';
-import {setDiagram} from "../store/diagram/actions";
+import {setDiagram, updateNodeStatus} from "../store/diagram/actions";
 import {setExercise, updateNodeState} from "../store/exercise/actions";
 import {setQueryResponse, setUpdateResponse} from '../store/irr/actions';
 import {setActiveTab} from '../store/ui/actions';
@@ -34,14 +34,29 @@ class App extends Component {
         this.ws = new Sockette('wss://' + window.location.hostname + '/ws/' + exercise.id + '/events', {
             'onopen': () => this.props.actions.setWSConnected(true),
             'onmessage': e => {
+                if (e.data.charAt(0) === 't') {
+                    // Compact terminal output: "t<node id>", a newline, and the output bytes as characters
+                    const newline = e.data.indexOf('\n');
+                    PubSub.publish("terminal-output-" + e.data.substring(1, newline), e.data.substring(newline + 1));
+                    return;
+                }
+
                 let data = JSON.parse(e.data);
                 switch (data.type) {
                     case 'state':
                         this.props.actions.updateNodeState(data.node, data.goal_type, data.content, data.ts);
                         break;
 
+                    case 'node-status':
+                        this.props.actions.updateNodeStatus(data.node_id, data.status);
+                        break;
+
                     case 'terminal-output':
-                        PubSub.publish("terminal-output-" + data.node_id, data.data);
+                        PubSub.publish("terminal-output-" + data.node_id, atob(data.data));
+                        break;
+
+                    case 'terminal-history':
+                        PubSub.publish("terminal-history-" + data.node_id, {request: data.request, data: atob(data.data)});
                         break;
 
                     case 'irr-query-response':
@@ -52,6 +67,15 @@ class App extends Component {
                         this.props.actions.setUpdateResponse(data['response']);
                         break;
 
+                    case 'exercise-power':
+                        if (data.action === 'stop' && data.state === 'done') {
+                            // The lab is gone, back to the overview
+                            window.location = '/';
+                        } else if (data.state !== 'done') {
+                            alert('Unable to ' + data.action + ' the lab: ' + data.state);
+                        }
+                        break;
+
                     default:
                         console.log(data);
                 }
@@ -162,6 +186,7 @@ function mapDispatchToProps(dispatch) {
             setExercise,
             updateNodeState,
             setDiagram,
+            updateNodeStatus,
             setActiveTab,
             setWSConnected,
             setQueryResponse,
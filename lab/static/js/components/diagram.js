@@ -108,6 +108,10 @@ class ProjectDiagram extends Component {
                     cursor: 'pointer',
                     };
 
+                if (this.props.diagram.show_state && node.status !== 'started') {
+                    style.filter = 'sepia(100%) saturate(300%) brightness(70%) hue-rotate(320deg)';
+                }
+
                 if (this.props.ui.active_tab === node.node_id) {
                     style.filter =
                         'drop-shadow(-1px -1px 1px white) ' +
@@ -19,13 +19,45 @@ export default class WorkNode extends Component {
             }
         });
         this.token = PubSub.subscribe("terminal-output-" + this.props.node.id, (evt, data) => {
-            this.term.write(atob(data));
+            // Output from before the history arrived is part of the history
+            if (!this.historyRequest) {
+                this.term.write(data);
+            }
+        });
+        this.historyToken = PubSub.subscribe("terminal-history-" + this.props.node.id, (evt, history) => {
+            if (history.request === this.historyRequest) {
+                this.historyRequest = null;
+                this.term.write(history.data);
+            }
         });
+
+        // Show what the console printed before we were here
+        this.historyRequest = Math.random().toString(36).substring(2);
+        try {
+            this.props.websocket.json({type: 'terminal-history', 'node_id': this.props.node.id, request: this.historyRequest});
+        } catch (e) {
+            this.historyRequest = null;
+        }
+
+        // Don't wait forever for a relay that doesn't answer
+        this.historyTimeout = setTimeout(() => this.historyRequest = null, 2000);
+
+        // The relay pauses consoles without open terminals
+        this.viewingInterval = setInterval(() => {
+            try {
+                this.props.websocket.json({type: 'terminal-viewing', 'node_id': this.props.node.id});
+            } catch (e) {
+                // Try again next time
+            }
+        }, 10000);
     }
 
     componentWillUnmount() {
         this.term && this.term.dispose();
         this.token && PubSub.unsubscribe(this.token);
+        this.historyToken && PubSub.unsubscribe(this.historyToken);
+        clearTimeout(this.historyTimeout);
+        clearInterval(this.viewingInterval);
     }
 
     render() {
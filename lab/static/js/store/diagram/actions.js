@@ -2,6 +2,7 @@
  * action types
  */
 export const SET_DIAGRAM = 'SET_DIAGRAM';
+export const UPDATE_NODE_STATUS = 'UPDATE_NODE_STATUS';
 
 /*
  * action creators
@@ -9,3 +10,7 @@ export const SET_DIAGRAM = 'SET_DIAGRAM';
 export function setDiagram(diagram) {
     return {type: SET_DIAGRAM, diagram}
 }
+
+export function updateNodeStatus(node_id, status) {
+    return {type: UPDATE_NODE_STATUS, node_id, status}
+}
@@ -11,6 +11,15 @@ export function diagram(state = initialState, action) {
         case actions.SET_DIAGRAM:
             return action.diagram;
 
+        case actions.UPDATE_NODE_STATUS:
+            return {
+                ...state,
+                nodes: state.nodes.map(node => node.node_id.toLowerCase() === action.node_id.toLowerCase() ? {
+                    ...node,
+                    status: action.status,
+                } : node),
+            };
+
         default:
             return state;
     }
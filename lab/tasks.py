@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from traceback import print_exc
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+from django.utils.translation import gettext as _
+from uwsgi_tasks import TaskExecutor, task
+from uwsgi_tasks.tasks import uwsgi
+
+from generic.utils import print_error, print_message, print_warning
+from lab.models import CloneJob, Exercise, ExerciseNode
+from lab.utils.gns3 import get_gns3_node
+
+# How often to look at the (cached) node status while waiting for GNS3
+POLL_INTERVAL = 1
+
+# Power changes mostly wait for GNS3 and enrollments clone a whole class, they get spoolers of their own so they
+# don't hold up each other or students cloning for themselves. These have to match the spoolers in uwsgi-django.ini.
+POWER_SPOOLER = os.path.join(os.path.realpath(settings.BASE_DIR), 'spool-power')
+ENROLL_SPOOLER = os.path.join(os.path.realpath(settings.BASE_DIR), 'spool-enroll')
+
+# The spooler-processes of every spooler in uwsgi-django.ini
+SPOOLER_PROCESSES = 4
+
+
+def spool(spooled_task, *args, **kwargs):
+    """
+    Hand a task to its uwsgi spooler, or to a background thread when we don't run under uwsgi (i.e. runserver)
+    """
+    if uwsgi:
+        return spooled_task(*args, **kwargs)
+
+    def run_in_thread():
+        try:
+            spooled_task.function(*args, **kwargs)
+        finally:
+            connection.close()
+
+    threading.Thread(target=run_in_thread, daemon=True).start()
+
+
+def run_clone_job(job_id: int):
+    job = CloneJob.objects.select_related('template', 'student').get(pk=job_id)
+    if job.state != CloneJob.QUEUED:
+        # Already handled
+        return
+
+    print_message(_("Cloning {template.name} for {student}").format(template=job.template, student=job.student))
+
+    # Time spent in the queue doesn't count
+    job.started = timezone.now()
+    job.save(update_fields=['started'])
+
+    try:
+        exercise = job.template.clone(name=job.name, student=job.student, time_limit=job.time_limit,
+                                      progress=job.set_state)
+    except Exception as e:
+        print_exc()
+        print_error(e)
+
+        # The exercise was removed again together with the rest of the clone
+        job.exercise = None
+        job.set_state(CloneJob.FAILED, error=str(e))
+        return
+
+    job.set_state(CloneJob.DONE, exercise=exercise)
+
+
+@task(executor=TaskExecutor.SPOOLER)
+def clone_template(job_id: int):
+    run_clone_job(job_id)
+
+
+@task(executor=TaskExecutor.SPOOLER, spooler=ENROLL_SPOOLER)
+def clone_templates(job_ids: list):
+    # One after the other, every chain takes one process of the enrollment spooler
+    for job_id in job_ids:
+        run_clone_job(job_id)
+
+
+def queue_clone(template, name: str, student, time_limit=None) -> CloneJob:
+    job = CloneJob.objects.create(template=template, name=name, student=student, time_limit=time_limit)
+    spool(clone_template, job.id)
+    return job
+
+
+def queue_clones(template, students, time_limit=None, concurrency=4) -> list:
+    """
+    Queue a clone job for every student, with at most `concurrency` of them being cloned at the same time, and no
+    more than the enrollment spooler has processes
+    """
+    jobs = [CloneJob.objects.create(template=template, name=template.get_exercise_name(student), student=student,
+                                    time_limit=time_limit)
+            for student in students]
+
+    concurrency = min(max(concurrency, 1), SPOOLER_PROCESSES)
+    for chain in range(min(concurrency, len(jobs))):
+        spool(clone_templates, [job.id for job in jobs[chain::concurrency]])
+
+    return jobs
+
+
+def power_lock_key(exercise_id: int) -> str:
+    return 'exercise_{}_power'.format(exercise_id)
+
+
+def wait_until(condition, timeout: float) -> bool:
+    """
+    Wait until condition() is true, giving up after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def change_exercise_power(exercise_id: int, action: str):
+    timeout = settings.GNS3.get('POWER_TIMEOUT', 180)
+    exercise = None
+
+    try:
+        # Inside the try, the lock has to be released even if the exercise is gone
+        exercise = Exercise.objects.get(pk=exercise_id)
+        print_message(_("{action} {exercise.name}").format(action=action.capitalize(), exercise=exercise))
+
+        if action == 'start':
+            exercise.gns3_start()
+            done = wait_until(lambda: exercise.is_running() is True, timeout)
+        else:
+            exercise.gns3_stop()
+            done = wait_until(lambda: exercise.is_running() is False, timeout)
+
+        state = 'done' if done else 'timeout'
+        if not done:
+            print_warning(_("Timeout while waiting for {exercise.name} to {action}").format(exercise=exercise,
+                                                                                          action=action))
+    except Exception as e:
+        print_exc()
+        print_error(e)
+        state = 'failed'
+    finally:
+        cache.delete(power_lock_key(exercise_id))
+
+    if not exercise:
+        return
+
+    exercise.publish_event({
+        'type': 'exercise-power',
+        'action': action,
+        'state': state,
+        'running': exercise.is_running(),
+    })
+
+
+@task(executor=TaskExecutor.SPOOLER, spooler=POWER_SPOOLER)
+def start_exercise(exercise_id: int):
+    change_exercise_power(exercise_id, 'start')
+
+
+@task(executor=TaskExecutor.SPOOLER, spooler=POWER_SPOOLER)
+def stop_exercise(exercise_id: int):
+    change_exercise_power(exercise_id, 'stop')
+
+
+@task(executor=TaskExecutor.SPOOLER, spooler=POWER_SPOOLER)
+def reload_node(exercise_id: int, node_id: int):
+    timeout = settings.GNS3.get('POWER_TIMEOUT', 180)
+    node = None
+
+    try:
+        # Inside the try, the lock has to be released even if the node is gone
+        node = ExerciseNode.objects.select_related('project').get(pk=node_id)
+        exercise = node.project
+        print_message(_("Reloading {node.name} of {exercise.name}").format(node=node, exercise=exercise))
+
+        def node_status():
+            return get_gns3_node(exercise.gns3_id, node.gns3_id)['status']
+
+        node.gns3_stop()
+        if wait_until(lambda: node_status() == 'stopped', timeout):
+            node.gns3_start()
+            done = wait_until(lambda: node_status() == 'started', timeout)
+        else:
+            done = False
+
+        state = 'done' if done else 'timeout'
+    except Exception as e:
+        print_exc()
+        print_error(e)
+        state = 'failed'
+    finally:
+        cache.delete(power_lock_key(exercise_id))
+
+    if not node:
+        return
+
+    node.project.publish_event({
+        'type': 'exercise-power',
+        'action': 'reload',
+        'state': state,
+        'node_id': node.id,
+    })
+
+
+def queue_power_change(power_task, exercise_id: int, *args) -> bool:
+    """
+    Queue a start, stop or reload, unless one is already in progress for this exercise
+    """
+    timeout = settings.GNS3.get('POWER_TIMEOUT', 180)
+
+    # The lock expires by itself in case the job dies without cleaning up
+    if not cache.add(power_lock_key(exercise_id), power_task.function.__name__, timeout * 2 + 10):
+        return False
+
+    spool(power_task, *args)
+    return True
+
+
+def queue_start(exercise: Exercise) -> bool:
+    return queue_power_change(start_exercise, exercise.id, exercise.id)
+
+
+def queue_stop(exercise: Exercise) -> bool:
+    return queue_power_change(stop_exercise, exercise.id, exercise.id)
+
+
+def queue_reload(node: ExerciseNode) -> bool:
+    return queue_power_change(reload_node, node.project_id, node.project_id, node.id)
@@ -0,0 +1,190 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from lab.models import (Exercise, ExerciseNode, ExerciseState, IRRGoal, IRRNode, IRRTemplate, MonitorGoal,
+                        MonitorNode, MonitorTemplate, Template, WorkNode)
+from lab.mules.gns3_notifications import ProjectWatcher
+from lab.utils.gns3 import gns3_nodes_key
+from lab.views.dashboard import get_dashboard_nodes
+
+
+class DashboardNodesTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.monitor_template = MonitorTemplate.objects.create(name='Monitor')
+        MonitorGoal.objects.create(monitor_template=cls.monitor_template, goal_type='Routes IPv4',
+                                   goal_content='10.0.0.0/8')
+        MonitorGoal.objects.create(monitor_template=cls.monitor_template, goal_type='Routes IPv6',
+                                   goal_content='2001:db8::/32')
+
+        cls.irr_template = IRRTemplate.objects.create(name='IRR')
+        IRRGoal.objects.create(irr_template=cls.irr_template, goal_type='NEIGHBORS', goal_content='AS64500')
+
+    @staticmethod
+    def mac_address(number: int) -> str:
+        return '02:00:00:00:{:02x}:{:02x}'.format(number // 256, number % 256)
+
+    def create_exercise(self, node_count: int) -> Exercise:
+        template = Template.objects.create(gns3_id=uuid4(), name='Template {}'.format(node_count))
+        exercise = Exercise.objects.create(gns3_id=uuid4(), name='Exercise {}'.format(node_count), based_on=template)
+
+        # Every kind of node, a third of each
+        for number in range(node_count):
+            kind = number % 3
+            fields = dict(project=template, gns3_id=uuid4(), name='node{}'.format(number),
+                          mac_address=self.mac_address(node_count * 100 + number))
+            if kind == 0:
+                template_node = WorkNode.objects.create(default_username='student', **fields)
+            elif kind == 1:
+                template_node = MonitorNode.objects.create(monitor_template=self.monitor_template, **fields)
+            else:
+                template_node = IRRNode.objects.create(irr_template=self.irr_template, maintainer='MAINT-LAB',
+                                                       **fields)
+
+            node = ExerciseNode.objects.create(project=exercise, gns3_id=uuid4(), name=template_node.name,
+                                               mac_address=self.mac_address(node_count * 100 + 50 + number),
+                                               template_node=template_node)
+            if kind == 1:
+                ExerciseState.objects.create(exercise_node=node, goal_type='Routes IPv4', state='10.0.0.0/8')
+
+        return exercise
+
+    def test_query_count_independent_of_nodes(self):
+        for node_count in (3, 6, 9):
+            exercise = self.create_exercise(node_count)
+
+            with self.subTest(nodes=node_count), self.assertNumQueries(5):
+                nodes = get_dashboard_nodes(exercise)
+
+            self.assertEqual(len(nodes), node_count)
+
+    def test_goals_and_states(self):
+        exercise = self.create_exercise(3)
+        nodes = {node['name']: node for node in get_dashboard_nodes(exercise).values()}
+
+        self.assertEqual(nodes['node0']['type'], 'WorkNode')
+        self.assertEqual(nodes['node0']['info']['username'], 'student')
+
+        self.assertEqual(nodes['node1']['type'], 'MonitorNode')
+        self.assertEqual(nodes['node1']['state']['Routes IPv4']['state'], '10.0.0.0/8')
+        self.assertEqual(nodes['node1']['state']['Routes IPv6']['state'], '')
+
+        self.assertEqual(nodes['node2']['type'], 'IRRNode')
+        self.assertEqual(nodes['node2']['info']['maintainer'], 'MAINT-LAB')
+        self.assertEqual(nodes['node2']['state']['NEIGHBORS']['goal'], 'AS64500')
+
+
+class FakeGNS3Server(ThreadingMixIn, HTTPServer):
+    """
+    Serves the nodes and the notification stream of one project, like a GNS3 server
+    """
+    daemon_threads = True
+
+    def __init__(self, project_id: str, nodes: list, notifications: list):
+        super().__init__(('127.0.0.1', 0), FakeGNS3Handler)
+        self.project_id = project_id
+        self.nodes = nodes
+        self.notifications = notifications
+        self.snapshot_taken = threading.Event()
+        self.stopped = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class FakeGNS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_json(self, content):
+        self.send_chunk(json.dumps(content).encode('utf-8') + b'\n')
+
+    def do_GET(self):
+        project_url = '/v2/projects/' + self.server.project_id
+        if self.path not in (project_url + '/nodes', project_url + '/notifications'):
+            self.send_error(404)
+            return
+
+        # Chunked like GNS3, so every notification arrives on its own
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        if self.path.endswith('/nodes'):
+            self.send_json(self.server.nodes)
+            self.send_chunk(b'')
+            self.server.snapshot_taken.set()
+            return
+
+        # Changes after the snapshot, then keep the stream open like GNS3 does
+        self.server.snapshot_taken.wait(5)
+        for notification in self.server.notifications:
+            self.send_json(notification)
+        self.server.stopped.wait(10)
+        self.send_chunk(b'')
+
+
+class ProjectWatcherTestCase(SimpleTestCase):
+    def setUp(self):
+        self.project_id = str(uuid4())
+        self.node_id = str(uuid4())
+        cache.clear()
+
+    def start_watcher(self, notifications: list) -> ProjectWatcher:
+        server = FakeGNS3Server(self.project_id, [{'node_id': self.node_id, 'name': 'node0', 'status': 'stopped'}],
+                                notifications)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        watcher = ProjectWatcher(self.project_id, base_url=server.base_url)
+        watcher.start()
+
+        # Cleanups run in reverse: end the stream first, closing it while it is being read waits for more data
+        self.addCleanup(watcher.join, 5)
+        self.addCleanup(watcher.stop)
+        self.addCleanup(server.stopped.set)
+        return watcher
+
+    def wait_for_nodes(self, check) -> list:
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            nodes = cache.get(gns3_nodes_key(self.project_id))
+            if nodes is not None and check(nodes.value):
+                return nodes.value
+            time.sleep(0.05)
+        self.fail('Snapshot not updated')
+
+    def test_snapshot_follows_notifications(self):
+        self.start_watcher([
+            {'action': 'ping', 'event': {}},
+            {'action': 'node.updated', 'event': {'node_id': self.node_id.upper(), 'status': 'started'}},
+            {'action': 'node.created', 'event': {'node_id': 'new-node', 'name': 'node1', 'status': 'stopped'}},
+        ])
+
+        nodes = self.wait_for_nodes(lambda nodes: len(nodes) == 2)
+        nodes = {node['name']: node for node in nodes}
+        self.assertEqual(nodes['node0']['status'], 'started')
+        self.assertEqual(nodes['node1']['status'], 'stopped')
+
+    def test_node_deleted(self):
+        self.start_watcher([
+            {'action': 'node.deleted', 'event': {'node_id': self.node_id}},
+        ])
+
+        self.wait_for_nodes(lambda nodes: nodes == [])
@@ -4,8 +4,8 @@ from lab.utils.gns3 import GNS3_UUID, get_gns3_nodes, get_gns3_projects
 def get_unknown_projects():
     from lab.models import Project
 
-    existing_project_ids = [str(project_id).lower() for project_id in
-                            Project.objects.all().values_list('gns3_id', flat=True)]
+    existing_project_ids = {str(project_id).lower() for project_id in
+                            Project.objects.all().values_list('gns3_id', flat=True)}
 
     for project in get_gns3_projects():
         if project['project_id'].lower() in existing_project_ids:
@@ -26,8 +26,8 @@ def get_unknown_project_choices():
 def get_unknown_nodes(template_id: GNS3_UUID):
     from lab.models import Node
 
-    existing_node_ids = [str(node_id).lower() for node_id in
-                         Node.objects.filter(project__gns3_id=template_id).values_list('gns3_id', flat=True)]
+    existing_node_ids = {str(node_id).lower() for node_id in
+                         Node.objects.filter(project__gns3_id=template_id).values_list('gns3_id', flat=True)}
 
     for node in get_gns3_nodes(template_id):
         if node['node_id'].lower() in existing_node_ids:
@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+from traceback import print_exc
+from typing import Any, Callable
+
+from django.core.cache import cache
+from redis_cache import RedisCache
+
+from generic.utils import print_error
+
+# Delete a lease only if it still holds our token, in one step
+RELEASE_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class CacheEntry:
+    """
+    A cached value with the moment it was fetched, which doubles as its version
+    """
+
+    def __init__(self, value: Any, ttl: float, fetched: float = None):
+        self.value = value
+        self.fetched = fetched or time.time()
+        self.expires = self.fetched + ttl
+
+    @property
+    def version(self):
+        return self.fetched
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+
+def store_single_flight(key: str, value: Any, ttl: float, *, stale_ttl: float = 60) -> CacheEntry:
+    """
+    Store a value that was obtained elsewhere in the same way get_single_flight() does
+    """
+    entry = CacheEntry(value, ttl)
+
+    # Keep the entry around for a while after it expires, so it can be served while it is being refreshed
+    cache.set(key, entry, ttl + stale_ttl)
+    return entry
+
+
+def _refresh(key: str, fetch: Callable[[], Any], ttl: float, stale_ttl: float) -> CacheEntry:
+    return store_single_flight(key, fetch(), ttl, stale_ttl=stale_ttl)
+
+
+def _take_lease(lease_key: str, lease_time: float):
+    # The token tells our lease apart from the one someone else took after ours expired. The Redis cache stores
+    # integers as they are, so the release script can compare it.
+    token = random.SystemRandom().randrange(1, 2 ** 62)
+    return token if cache.add(lease_key, token, lease_time) else None
+
+
+def _release_lease(lease_key: str, token: int):
+    if isinstance(cache, RedisCache):
+        key = cache.make_key(lease_key)
+        cache.get_client(key, write=True).eval(RELEASE_LEASE, 1, key, token)
+    elif cache.get(lease_key) == token:
+        # Other caches only live in one process
+        cache.delete(lease_key)
+
+
+def _refresh_in_background(key: str, lease_key: str, token: int, fetch: Callable[[], Any],
+                           ttl: float, stale_ttl: float):
+    try:
+        _refresh(key, fetch, ttl, stale_ttl)
+    except Exception as e:
+        print_exc()
+        print_error(e)
+    finally:
+        _release_lease(lease_key, token)
+
+
+def get_single_flight(key: str, fetch: Callable[[], Any], ttl: float, *,
+                      stale_ttl: float = 60, lease_time: float = 10, wait: float = 2) -> CacheEntry:
+    """
+    Get an entry from the cache, making sure only one process at a time fetches a new value for it.
+
+    Fresh entries are returned immediately. Expired entries are still returned while one process refreshes them in
+    the background. When there is no entry at all the first process fetches it while the others wait for it, for at
+    most `wait` seconds before fetching it themselves.
+    """
+    lease_key = key + '|lease'
+
+    entry = cache.get(key)
+    if entry:
+        if not entry.is_fresh():
+            token = _take_lease(lease_key, lease_time)
+            if token:
+                # Stale: serve it anyway and let someone refresh it
+                threading.Thread(target=_refresh_in_background,
+                                 args=(key, lease_key, token, fetch, ttl, stale_ttl), daemon=True).start()
+
+        return entry
+
+    token = _take_lease(lease_key, lease_time)
+    if token:
+        # We are the one fetching
+        try:
+            return _refresh(key, fetch, ttl, stale_ttl)
+        finally:
+            _release_lease(lease_key, token)
+
+    # Someone else is fetching, wait for the result
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry:
+            return entry
+
+    # Waited long enough, do it ourselves
+    return _refresh(key, fetch, ttl, stale_ttl)
@@ -1,6 +1,40 @@
+import hashlib
+import json
 import re
 
-from lab.utils.gns3 import get_gns3_session, gns3_base_url
+from django.core.cache import cache
+
+from lab.utils.cache import get_single_flight, store_single_flight
+from lab.utils.gns3 import GNS3Client, get_gns3_client, get_gns3_nodes, gns3_base_url
+from lab.utils.inventory import get_gns3_node_inventory
+
+# The layout only changes when someone edits the project in GNS3, and sync_projects notices that
+LAYOUT_TTL = 3600
+
+# The fields of a node that determine what the diagram looks like. The node_id is left out on purpose: exercises
+# have the same layout as their template, just with different UUIDs.
+LAYOUT_NODE_FIELDS = ('name', 'x', 'y', 'z', 'width', 'height', 'symbol', 'label')
+LAYOUT_DRAWING_FIELDS = ('svg', 'x', 'y', 'z', 'rotation')
+
+
+def layout_hash(raw_nodes: list, raw_links: list = (), raw_drawings: list = ()) -> str:
+    """
+    Hash of the whole topology, with links pointing to node names instead of UUIDs for the same reason
+    """
+    names = {node['node_id']: node.get('name') for node in raw_nodes}
+
+    nodes = sorted([[node.get(field) for field in LAYOUT_NODE_FIELDS] for node in raw_nodes], key=json.dumps)
+    links = sorted([[[names.get(end['node_id']), end.get('adapter_number'), end.get('port_number'), end.get('label')]
+                     for end in link['nodes']] for link in raw_links], key=json.dumps)
+    drawings = sorted([[drawing.get(field) for field in LAYOUT_DRAWING_FIELDS] for drawing in raw_drawings],
+                      key=json.dumps)
+
+    return hashlib.sha1(json.dumps([nodes, links, drawings], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def topology_changed_key(project_id) -> str:
+    # Set by the notification mule when links or drawings change, which the node list doesn't show
+    return 'diagram_' + str(project_id).lower() + '_topology_changed'
 
 
 class ProjectDiagram:
@@ -11,6 +45,23 @@ class ProjectDiagram:
     def gns3_id(self):
         return str(self.project.gns3_id).lower()
 
+    @property
+    def layout_key(self):
+        return 'diagram_' + self.gns3_id + '_layout'
+
+    @property
+    def topology_changed_key(self):
+        return topology_changed_key(self.gns3_id)
+
+    @property
+    def node_map_key(self):
+        return 'diagram_' + self.gns3_id + '_node_map'
+
+    @property
+    def template(self):
+        # Exercises share the layout of the template they were cloned from
+        return getattr(self.project, 'based_on', None)
+
     @staticmethod
     def get_width(item):
         if 'width' in item:
@@ -35,13 +86,21 @@ class ProjectDiagram:
 
         return 0
 
-    def get_data(self, show_state=True):
-        session = get_gns3_session()
+    def get_links_and_drawings(self, *, session: GNS3Client):
+        raw_links = session.get(gns3_base_url + '/v2/projects/' + self.gns3_id + '/links').json()
+        raw_drawings = session.get(gns3_base_url + '/v2/projects/' + self.gns3_id + '/drawings').json()
+        return raw_links, raw_drawings
+
+    def build_layout(self, *, session: GNS3Client = None):
+        """
+        Everything about the diagram except the status of the nodes
+        """
+        if not session:
+            session = get_gns3_client()
 
         session.post(gns3_base_url + '/v2/projects/' + self.gns3_id + '/open')
-        raw_drawings = session.get(gns3_base_url + '/v2/projects/' + self.gns3_id + '/drawings').json()
-        raw_nodes = session.get(gns3_base_url + '/v2/projects/' + self.gns3_id + '/nodes').json()
-        raw_links = session.get(gns3_base_url + '/v2/projects/' + self.gns3_id + '/links').json()
+        raw_nodes = get_gns3_nodes(self.gns3_id, session=session)
+        raw_links, raw_drawings = self.get_links_and_drawings(session=session)
 
         # Normalise coordinates
         xs = [item['x'] for item in raw_nodes + raw_drawings]
@@ -71,7 +130,7 @@ class ProjectDiagram:
         for raw_node in raw_nodes:
             nodes.append({
                 'node_id': raw_node['node_id'],
-                'status': raw_node['status'],
+                'name': raw_node['name'],
                 'width': raw_node['width'],
                 'height': raw_node['height'],
                 'symbol': raw_node['symbol'],
@@ -111,10 +170,117 @@ class ProjectDiagram:
             links.append(link)
 
         return {
-            'show_state': show_state,
+            'hash': layout_hash(raw_nodes, raw_links, raw_drawings),
+            'nodes_hash': layout_hash(raw_nodes),
             'scene_width': highest_x - lowest_x,
             'scene_height': highest_y - lowest_y,
             'drawings': drawings,
             'links': links,
             'nodes': nodes,
         }
+
+    def get_node_map(self, layout: dict):
+        """
+        Map the node UUIDs of the template layout to the ones of this exercise, or None if they don't match
+        """
+        from lab.models import ExerciseNode
+
+        entry = cache.get(self.node_map_key)
+        if entry and entry[0] == layout['hash']:
+            return entry[1]
+
+        node_map = {}
+        for node in ExerciseNode.objects.filter(project_id=self.project.id).select_related('template_node'):
+            node_map[str(node.template_node.gns3_id).lower()] = str(node.gns3_id).lower()
+
+        # Other nodes, like switches, are only known to GNS3 and are found by name
+        server_nodes = None
+        for node in layout['nodes']:
+            template_node_id = node['node_id'].lower()
+            if template_node_id in node_map:
+                continue
+
+            if server_nodes is None:
+                server_nodes = get_gns3_node_inventory(self.gns3_id)
+
+            server_node = server_nodes.get_by_name(node['name'])
+            if not server_node:
+                return None
+
+            node_map[template_node_id] = server_node['node_id']
+
+        # Remembered until the template layout changes
+        cache.set(self.node_map_key, (layout['hash'], node_map), LAYOUT_TTL)
+        return node_map
+
+    def get_layout(self) -> dict:
+        if self.template:
+            entry = cache.get(self.layout_key)
+            if entry:
+                # This exercise no longer looks like its template
+                return entry.value
+
+            layout = ProjectDiagram(self.template).get_layout()
+            node_map = self.get_node_map(layout)
+            if node_map is not None:
+                return dict(layout, nodes=[dict(node, node_id=node_map[node['node_id'].lower()])
+                                           for node in layout['nodes']])
+
+        return get_single_flight(self.layout_key, self.build_layout, LAYOUT_TTL).value
+
+    def refresh_layout(self, raw_nodes: list, *, session: GNS3Client = None):
+        """
+        Rebuild the cached layout when the topology in GNS3 no longer matches it. Links and drawings are only fetched
+        when the nodes changed, or when the notification mule saw them change.
+        """
+        if not cache.get(self.topology_changed_key):
+            entry = cache.get(self.layout_key)
+            if entry:
+                layout = entry.value
+            elif self.template:
+                layout = ProjectDiagram(self.template).get_layout()
+            else:
+                layout = None
+
+            if layout and layout.get('nodes_hash') == layout_hash(raw_nodes):
+                return False
+
+        # Before fetching, so changes from now on are noticed next time
+        cache.delete(self.topology_changed_key)
+
+        if not session:
+            session = get_gns3_client()
+
+        raw_links, raw_drawings = self.get_links_and_drawings(session=session)
+        current_hash = layout_hash(raw_nodes, raw_links, raw_drawings)
+
+        if self.template and ProjectDiagram(self.template).get_layout()['hash'] == current_hash:
+            # Identical to the template, so share its layout
+            cache.delete(self.layout_key)
+            return False
+
+        entry = cache.get(self.layout_key)
+        if entry and entry.value['hash'] == current_hash:
+            return False
+
+        store_single_flight(self.layout_key, self.build_layout(session=session), LAYOUT_TTL)
+        return True
+
+    def get_data(self, show_state=True):
+        layout = self.get_layout()
+
+        # The status is kept up to date by the notification mule, so it comes from the node cache
+        server_nodes = get_gns3_node_inventory(self.gns3_id)
+        nodes = []
+        for node in layout['nodes']:
+            server_node = server_nodes.get(node['node_id'])
+            nodes.append(dict(node, status=server_node['status'] if server_node else 'stopped'))
+
+        return {
+            'show_state': show_state,
+            'scene_width': layout['scene_width'],
+            'scene_height': layout['scene_height'],
+            'drawings': layout['drawings'],
+            'links': layout['links'],
+            'nodes': nodes,
+        }
@@ -0,0 +1,94 @@
+import time
+from collections import namedtuple
+from typing import Optional
+
+from django.core.cache import cache
+
+# What the long-running mules need to know about an exercise node, without loading models
+NodeInfo = namedtuple('NodeInfo', ['id', 'gns3_id', 'name', 'project_id', 'project_name', 'kind'])
+
+VERSION_KEY = 'exercise_node_directory_version'
+
+
+def bump_node_directory():
+    # Tell all directories that exercise nodes were added or removed
+    cache.set(VERSION_KEY, time.time(), None)
+
+
+def node_directory_version():
+    return cache.get(VERSION_KEY)
+
+
+class NodeDirectory:
+    """
+    All exercise nodes, indexed by lower-cased GNS3 UUID and by ID, loaded with a single query
+    """
+
+    def __init__(self, min_reload_interval: float = 5):
+        self.min_reload_interval = min_reload_interval
+        self.by_uuid = {}
+        self.by_id = {}
+        self.version = None
+        self.loaded = None
+        self.checked = None
+
+    def load(self):
+        from lab.models import ExerciseNode
+
+        self.version = node_directory_version()
+        self.loaded = self.checked = time.monotonic()
+
+        nodes = ExerciseNode.objects.values_list('id', 'gns3_id', 'name', 'project_id', 'project__name',
+                                                 'template_node__worknode', 'template_node__monitornode',
+                                                 'template_node__irrnode')
+        by_uuid = {}
+        by_id = {}
+        for node_id, gns3_id, name, project_id, project_name, work_node, monitor_node, irr_node in nodes.iterator():
+            if irr_node:
+                kind = 'IRRNode'
+            elif monitor_node:
+                kind = 'MonitorNode'
+            elif work_node:
+                kind = 'WorkNode'
+            else:
+                kind = None
+
+            info = NodeInfo(node_id, str(gns3_id).lower(), name, project_id, project_name, kind)
+            by_uuid[info.gns3_id] = info
+            by_id[node_id] = info
+
+        self.by_uuid = by_uuid
+        self.by_id = by_id
+
+    def refresh(self, force=False):
+        """
+        Reload when exercise nodes changed, but check no more often than min_reload_interval unless forced
+        """
+        if force or self.loaded is None:
+            self.load()
+            return True
+
+        now = time.monotonic()
+        if now - self.checked < self.min_reload_interval:
+            return False
+
+        self.checked = now
+        if self.version != node_directory_version():
+            self.load()
+            return True
+
+        return False
+
+    def get_by_uuid(self, gns3_id) -> Optional[NodeInfo]:
+        gns3_id = str(gns3_id).lower()
+        if gns3_id not in self.by_uuid:
+            # Maybe it was just created
+            self.refresh()
+
+        return self.by_uuid.get(gns3_id)
+
+    def get(self, node_id: int) -> Optional[NodeInfo]:
+        if node_id not in self.by_id:
+            self.refresh()
+
+        return self.by_id.get(node_id)
@@ -0,0 +1,145 @@
+import csv
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from traceback import print_exc
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from generic.utils import print_error
+
+
+class EnrollmentResult:
+    def __init__(self, student, exercise=None, error=None, duration=0.0, state=None):
+        self.student = student
+        self.exercise = exercise
+        self.error = error
+        self.duration = duration
+
+        # Display of the state of a clone job that is still running
+        self.state = state
+
+    @classmethod
+    def from_job(cls, job):
+        # From the moment a spooler picked it up
+        if not job.started:
+            duration = 0.0
+        elif job.is_pending():
+            duration = (timezone.now() - job.started).total_seconds()
+        else:
+            duration = (job.updated - job.started).total_seconds()
+
+        if job.is_pending():
+            return cls(job.student, duration=duration, state=job.get_state_display())
+
+        return cls(job.student, exercise=job.exercise if job.state == job.DONE else None,
+                   error=job.error or job.get_state_display(), duration=duration)
+
+    @property
+    def success(self):
+        return self.exercise is not None
+
+    @property
+    def pending(self):
+        return self.state is not None
+
+
+class EnrollmentReport:
+    def __init__(self, results: list, wall_time: float):
+        self.results = results
+        self.wall_time = wall_time
+
+    @classmethod
+    def from_jobs(cls, jobs: list):
+        """
+        The report of clone jobs queued by queue_clones(), while they run and after
+        """
+        if not jobs:
+            return cls([], 0.0)
+
+        start = min(job.created for job in jobs)
+        if any(job.is_pending() for job in jobs):
+            end = timezone.now()
+        else:
+            end = max(job.updated for job in jobs)
+
+        return cls([EnrollmentResult.from_job(job) for job in jobs], (end - start).total_seconds())
+
+    @property
+    def succeeded(self):
+        return len([result for result in self.results if result.success])
+
+    @property
+    def pending(self):
+        return len([result for result in self.results if result.pending])
+
+    @property
+    def failed(self):
+        return len(self.results) - self.succeeded - self.pending
+
+    @property
+    def throughput(self):
+        # Exercises per minute
+        if not self.wall_time:
+            return 0.0
+
+        return self.succeeded * 60 / self.wall_time
+
+
+def parse_students(text: str):
+    """
+    Find the users listed in CSV text, by username or email address in the first column of every row
+    """
+    User = get_user_model()
+
+    identifiers = []
+    for row in csv.reader(StringIO(text)):
+        if row and row[0].strip() and not row[0].strip().startswith('#'):
+            identifiers.append(row[0].strip())
+
+    users = User.objects.filter(Q(**{User.USERNAME_FIELD + '__in': identifiers}) |
+                                Q(**{User.get_email_field_name() + '__in': identifiers}))
+    found = {}
+    for user in users:
+        found[user.get_username()] = user
+        found[getattr(user, User.get_email_field_name())] = user
+
+    students = []
+    unknown = []
+    for identifier in identifiers:
+        if identifier in found:
+            if found[identifier] not in students:
+                students.append(found[identifier])
+        else:
+            unknown.append(identifier)
+
+    return students, unknown
+
+
+def _enroll_student(template, student, time_limit):
+    start = time.time()
+    try:
+        exercise = template.clone(name=template.get_exercise_name(student), student=student, time_limit=time_limit)
+        return EnrollmentResult(student, exercise=exercise, duration=time.time() - start)
+    except Exception as e:
+        print_exc()
+        print_error(e)
+        return EnrollmentResult(student, error=str(e), duration=time.time() - start)
+    finally:
+        # Every thread has its own database connection
+        connection.close()
+
+
+def enroll_students(template, students, time_limit=None, concurrency=4) -> EnrollmentReport:
+    """
+    Clone the template for every student right away, with at most `concurrency` clones running at the same time.
+    Web requests use queue_clones() instead.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        results = list(executor.map(lambda student: _enroll_student(template, student, time_limit), students))
+
+    return EnrollmentReport(results, time.time() - start)
@@ -1,11 +1,18 @@
+import os
 import re
+import threading
 from typing import Union
 from uuid import UUID
 
 from django.conf import settings
-from django.core.cache import cache
-from requests import RequestException, Session
+from requests import ConnectionError, RequestException, Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+from lab.utils.cache import CacheEntry, get_single_flight, store_single_flight
 
 # Construct monitor connection option
 monitor_option = '-serial tcp:{ADDRESS}:{PORT},reconnect=5'.format(**settings.STATE_COLLECTOR)
@@ -20,57 +27,169 @@ def raise_exception_on_fail(response, *_args, **_kwargs):
         raise RequestException(response.reason, response=response)
 
 
-def get_gns3_session():
-    user = settings.GNS3.get('USER', None)
-    password = settings.GNS3.get('PASSWORD', None)
+class GNS3ConnectionStats:
+    """
+    Per-process counters of the requests made to the GNS3 server and the TCP connections opened for them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_new_connection(self):
+        with self.lock:
+            self.new_connections += 1
+
+    @property
+    def reused_connections(self):
+        return max(self.requests - self.new_connections, 0)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+        }
+
+
+gns3_stats = GNS3ConnectionStats()
+
+
+class GNS3Connection(HTTPConnection):
+    def connect(self):
+        gns3_stats.count_new_connection()
+        super().connect()
+
+
+class GNS3ConnectionPool(HTTPConnectionPool):
+    ConnectionCls = GNS3Connection
+
+    def _get_conn(self, timeout=None):
+        # The pool blocks when all connections are in use, but not forever
+        if timeout is None:
+            timeout = settings.GNS3.get('POOL_TIMEOUT', 10)
+        return super()._get_conn(timeout=timeout)
+
+
+class GNS3Adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        # Use our own connection class so we can count the connections being made
+        self.poolmanager.pool_classes_by_scheme = {
+            **self.poolmanager.pool_classes_by_scheme,
+            'http': GNS3ConnectionPool,
+        }
+
+    def send(self, request, *args, **kwargs):
+        try:
+            return super().send(request, *args, **kwargs)
+        except EmptyPoolError as e:
+            # Handled like any other failure to reach GNS3
+            raise ConnectionError(e, request=request)
+
+
+class GNS3Client(Session):
+    """
+    A session with a keep-alive connection pool to the GNS3 server, meant to be shared by everything in this process
+    """
 
-    session = Session()
-    if user and password:
-        session.auth = HTTPBasicAuth(username=user, password=password)
+    def __init__(self):
+        super().__init__()
 
-    session.hooks = {
-        'response': raise_exception_on_fail
-    }
+        user = settings.GNS3.get('USER', None)
+        password = settings.GNS3.get('PASSWORD', None)
+        if user and password:
+            self.auth = HTTPBasicAuth(username=user, password=password)
 
-    return session
+        self.hooks = {
+            'response': raise_exception_on_fail
+        }
 
+        self.timeout = (settings.GNS3.get('CONNECT_TIMEOUT', 5), settings.GNS3.get('READ_TIMEOUT', 120))
 
-def get_gns3_projects(*, session: Session = None):
-    projects = cache.get('gns3_projects')
-    if not projects:
-        if not session:
-            session = get_gns3_session()
-        projects = session.get(gns3_base_url + '/v2/projects').json()
-        cache.set('gns3_projects', projects, 10)
+        # Limit the number of connections we keep open, and wait for a free one instead of opening more
+        pool_size = settings.GNS3.get('POOL_SIZE', 10)
+        adapter = GNS3Adapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.mount('http://', adapter)
 
-    return projects
+    @property
+    def stats(self):
+        return gns3_stats.as_dict()
 
+    def request(self, method, url, *args, **kwargs):
+        # Never without timeouts, a hanging request would keep its pooled connection forever
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        gns3_stats.count_request()
+        return super().request(method, url, *args, **kwargs)
 
-def get_gns3_nodes(project_id: GNS3_UUID, *, session: Session = None):
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_gns3_client() -> GNS3Client:
+    global _client, _client_pid
+
+    # Sockets must not be shared between forked uwsgi workers, so every process gets its own client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = GNS3Client()
+            _client_pid = os.getpid()
+
+        return _client
+
+
+def get_gns3_projects_entry(*, session: GNS3Client = None) -> CacheEntry:
+    def fetch():
+        return (session or get_gns3_client()).get(gns3_base_url + '/v2/projects').json()
+
+    return get_single_flight('gns3_projects', fetch, 10)
+
+
+def get_gns3_projects(*, session: GNS3Client = None):
+    return get_gns3_projects_entry(session=session).value
+
+
+def gns3_nodes_key(project_id: GNS3_UUID):
+    return 'gns3_' + str(project_id).lower() + '_nodes'
+
+
+def get_gns3_nodes_entry(project_id: GNS3_UUID, *, session: GNS3Client = None) -> CacheEntry:
     project_id = str(project_id).lower()
 
-    nodes = cache.get('gns3_' + project_id + '_nodes')
-    if not nodes:
-        if not session:
-            session = get_gns3_session()
-        nodes = session.get(gns3_base_url + '/v2/projects/' + project_id + '/nodes').json()
-        cache.set('gns3_' + project_id + '_nodes', nodes, 3)
+    def fetch():
+        return (session or get_gns3_client()).get(gns3_base_url + '/v2/projects/' + project_id + '/nodes').json()
 
-    return nodes
+    # The notification mule keeps this key up to date while it is running, this only polls when it isn't
+    return get_single_flight(gns3_nodes_key(project_id), fetch, 3)
 
 
-def get_gns3_node(project_id: GNS3_UUID, node_id: GNS3_UUID, *, session: Session = None):
-    # Optimization: get all (cached) nodes, and get the result from there
-    nodes = get_gns3_nodes(project_id, session=session)
+def get_gns3_nodes(project_id: GNS3_UUID, *, session: GNS3Client = None):
+    return get_gns3_nodes_entry(project_id, session=session).value
 
-    node_id = str(node_id).lower()
 
-    for node in nodes:
-        if node['node_id'].lower() == node_id:
-            return node
+def store_gns3_nodes(project_id: GNS3_UUID, nodes: list, ttl: float):
+    store_single_flight(gns3_nodes_key(project_id), nodes, ttl)
+
+
+def get_gns3_node(project_id: GNS3_UUID, node_id: GNS3_UUID, *, session: GNS3Client = None):
+    from lab.utils.inventory import get_gns3_node_inventory
+
+    # Optimization: get all (cached) nodes, and get the result from there
+    node = get_gns3_node_inventory(project_id, session=session).get(node_id)
+    if node is None:
+        # Simulate a request error
+        raise RequestException('Not Found')
 
-    # Simulate a request error
-    raise RequestException('Not Found')
+    return node
 
 
 def fix_monitor_option(options):
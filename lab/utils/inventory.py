@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from django.core.cache import cache
+from netaddr import AddrFormatError, EUI
+from requests import RequestException
+
+from lab.utils.cache import CacheEntry
+from lab.utils.gns3 import (GNS3Client, GNS3_UUID, get_gns3_client, get_gns3_nodes, get_gns3_nodes_entry,
+                             get_gns3_projects_entry, gns3_nodes_key)
+
+# Inventories built in this process, with the version of the cache entry they were built from
+_inventories = {}
+
+
+def mac_key(mac_address) -> Optional[int]:
+    if not mac_address:
+        return None
+
+    try:
+        return int(EUI(mac_address))
+    except (AddrFormatError, TypeError, ValueError):
+        return None
+
+
+class ProjectInventory:
+    """
+    The projects on the GNS3 server, indexed by their lower-cased UUID
+    """
+
+    def __init__(self, projects: list):
+        self.projects = projects
+        self.by_id = {project['project_id'].lower(): project for project in projects}
+
+    def __iter__(self):
+        return iter(self.projects)
+
+    def __contains__(self, project_id: GNS3_UUID):
+        return str(project_id).lower() in self.by_id
+
+    def get(self, project_id: GNS3_UUID) -> Optional[dict]:
+        return self.by_id.get(str(project_id).lower())
+
+
+class NodeInventory:
+    """
+    The nodes of one GNS3 project, indexed by their lower-cased UUID, their MAC address and their name
+    """
+
+    def __init__(self, nodes: list):
+        self.nodes = nodes
+        self.by_id = {}
+        self.by_mac = {}
+        self.by_name = {}
+
+        for node in nodes:
+            self.by_id[node['node_id'].lower()] = node
+
+            key = mac_key(node.get('properties', {}).get('mac_address'))
+            if key is not None:
+                self.by_mac.setdefault(key, node)
+
+            if 'name' in node:
+                self.by_name.setdefault(node['name'], node)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __contains__(self, node_id: GNS3_UUID):
+        return str(node_id).lower() in self.by_id
+
+    def get(self, node_id: GNS3_UUID) -> Optional[dict]:
+        return self.by_id.get(str(node_id).lower())
+
+    def get_by_mac(self, mac_address) -> Optional[dict]:
+        key = mac_key(mac_address)
+        if key is None:
+            return None
+
+        return self.by_mac.get(key)
+
+    def get_by_name(self, name: str) -> Optional[dict]:
+        return self.by_name.get(name)
+
+
+def _get_inventory(key: str, entry: CacheEntry, inventory_class):
+    # Build the indexes only once for every fetch of the raw data
+    version, inventory = _inventories.get(key, (None, None))
+    if version != entry.version:
+        inventory = inventory_class(entry.value)
+        _inventories[key] = (entry.version, inventory)
+
+    return inventory
+
+
+def get_gns3_project_inventory(*, session: GNS3Client = None) -> ProjectInventory:
+    return _get_inventory('gns3_projects', get_gns3_projects_entry(session=session), ProjectInventory)
+
+
+def get_gns3_node_inventory(project_id: GNS3_UUID, *, session: GNS3Client = None) -> NodeInventory:
+    return _get_inventory(gns3_nodes_key(project_id), get_gns3_nodes_entry(project_id, session=session),
+                          NodeInventory)
+
+
+def running_state(nodes: list) -> Optional[bool]:
+    """
+    True when all nodes are started, False when none are, and None for anything in between
+    """
+    total = len(nodes)
+    running = len([node for node in nodes if node['status'] == 'started'])
+    if running == total:
+        return True
+    elif running == 0:
+        return False
+    else:
+        return None
+
+
+def get_running_states(project_ids: Iterable[GNS3_UUID], *, concurrency: int = 8) -> dict:
+    """
+    Determine the running state of many projects at once, keyed by lower-cased UUID.
+
+    Uses one project listing, the node snapshots that are already in the cache, and fetches the nodes of the
+    remaining open projects in parallel.
+    """
+    project_ids = {str(project_id).lower() for project_id in project_ids}
+    if not project_ids:
+        return {}
+
+    session = get_gns3_client()
+    try:
+        projects = get_gns3_project_inventory(session=session)
+    except RequestException:
+        return {project_id: None for project_id in project_ids}
+
+    states = {}
+    open_projects = []
+    for project_id in project_ids:
+        project = projects.get(project_id)
+        if not project:
+            states[project_id] = None
+        elif project.get('status') != 'opened':
+            # Nothing runs in a closed project
+            states[project_id] = False
+        else:
+            open_projects.append(project_id)
+
+    snapshots = cache.get_many([gns3_nodes_key(project_id) for project_id in open_projects])
+    missing = []
+    for project_id in open_projects:
+        entry = snapshots.get(gns3_nodes_key(project_id))
+        if entry:
+            states[project_id] = running_state(entry.value)
+        else:
+            missing.append(project_id)
+
+    def fetch_state(project_id):
+        try:
+            return running_state(get_gns3_nodes(project_id, session=session))
+        except RequestException:
+            return None
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(len(missing), concurrency)) as executor:
+            states.update(zip(missing, executor.map(fetch_state, missing)))
+
+    return states
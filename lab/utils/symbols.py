@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+from tempfile import NamedTemporaryFile
+from typing import Optional
+from urllib.parse import quote
+
+from django.conf import settings
+from requests import RequestException
+
+from generic.utils import print_error
+from lab.utils.cache import get_single_flight
+from lab.utils.gns3 import GNS3Client, get_gns3_client, get_gns3_nodes, get_gns3_projects, gns3_base_url
+
+Symbol = namedtuple('Symbol', ['data', 'content_type', 'etag'])
+
+# The catalogue only changes when someone adds symbols to the GNS3 server
+CATALOGUE_TTL = 3600
+
+
+def get_symbol_dir() -> str:
+    return settings.GNS3.get('SYMBOL_DIR', os.path.join(settings.BASE_DIR, 'symbols'))
+
+
+def symbol_path(symbol_id: str) -> str:
+    # Symbol IDs look like paths (':/symbols/router.svg'), so don't use them as file names directly
+    return os.path.join(get_symbol_dir(), hashlib.sha1(symbol_id.encode('utf-8')).hexdigest())
+
+
+def get_symbol_catalogue(*, session: GNS3Client = None) -> set:
+    def fetch():
+        symbols = (session or get_gns3_client()).get(gns3_base_url + '/v2/symbols').json()
+        return {symbol['symbol_id'] for symbol in symbols}
+
+    return get_single_flight('gns3_symbols', fetch, CATALOGUE_TTL).value
+
+
+def load_symbol(symbol_id: str) -> Optional[Symbol]:
+    path = symbol_path(symbol_id)
+    try:
+        with open(path + '.json') as meta_file:
+            meta = json.load(meta_file)
+        with open(path, 'rb') as data_file:
+            data = data_file.read()
+    except (OSError, ValueError):
+        return None
+
+    return Symbol(data, meta['content_type'], meta['etag'])
+
+
+def store_symbol(symbol_id: str, data: bytes, content_type: str) -> Symbol:
+    symbol = Symbol(data, content_type, hashlib.sha1(data).hexdigest())
+
+    # Write to temporary files and move them in place, so other processes never see half a symbol
+    path = symbol_path(symbol_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as data_file:
+        data_file.write(data)
+    os.replace(data_file.name, path)
+    with NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as meta_file:
+        json.dump({'symbol_id': symbol_id, 'content_type': content_type, 'etag': symbol.etag}, meta_file)
+    os.replace(meta_file.name, path + '.json')
+
+    return symbol
+
+
+def get_symbol(symbol_id: str, *, session: GNS3Client = None) -> Optional[Symbol]:
+    symbol = load_symbol(symbol_id)
+    if symbol:
+        return symbol
+
+    if not session:
+        session = get_gns3_client()
+
+    if symbol_id not in get_symbol_catalogue(session=session):
+        return None
+
+    response = session.get(gns3_base_url + '/v2/symbols/' + quote(symbol_id) + '/raw')
+    return store_symbol(symbol_id, response.content, response.headers.get('content-type', 'image/svg+xml'))
+
+
+def warm_symbols(*, session: GNS3Client = None) -> int:
+    """
+    Make sure the symbols of all projects on the GNS3 server are in the store
+    """
+    if not session:
+        session = get_gns3_client()
+
+    symbol_ids = set()
+    for project in get_gns3_projects(session=session):
+        if project.get('status') != 'opened':
+            continue
+
+        try:
+            symbol_ids.update(node['symbol'] for node in get_gns3_nodes(project['project_id'], session=session))
+        except RequestException as e:
+            print_error(e)
+
+    count = 0
+    for symbol_id in symbol_ids:
+        try:
+            if get_symbol(symbol_id, session=session):
+                count += 1
+        except (OSError, RequestException) as e:
+            print_error(e)
+
+    return count
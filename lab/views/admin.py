@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.admin.helpers import Fieldset
 from django.core.exceptions import PermissionDenied
 from django.http import Http404
@@ -12,9 +12,11 @@ from django.views import View
 from django.views.generic.base import ContextMixin, TemplateResponseMixin
 
 from lab.apps import LabConfig
-from lab.forms import NodeAddForm, StudentAddForm
-from lab.models import Exercise, IRRNode, MonitorNode, Template, WorkNode
+from lab.forms import NodeAddForm, StudentAddForm, StudentsEnrollForm
+from lab.models import CloneJob, Exercise, IRRNode, MonitorNode, Template, WorkNode
+from lab.tasks import queue_clone, queue_clones
 from lab.utils.diagram import ProjectDiagram
+from lab.utils.enrollment import EnrollmentReport
 from lab.utils.gns3 import get_gns3_node
 from lab.views.utils import DrawingView
 
@@ -151,22 +153,14 @@ class StudentAddView(TemplateResponseMixin, ContextMixin, View):
             form = StudentAddForm(request.POST, **form_kwargs)
 
             if form.is_valid():
-                # Clean up template name
-                name = form.cleaned_data['template'].name
-                if name.lower().startswith('template'):
-                    name = name[8:]
-                name = name.strip(':_- ')
-
-                # Add student name to project name
-                project_name = name + ' for ' + (
-                        form.cleaned_data['student'].get_full_name() or
-                        form.cleaned_data['student'].username
-                )
+                project_name = form.cleaned_data['template'].get_exercise_name(form.cleaned_data['student'])
 
-                # Clone the template
-                form.cleaned_data['template'].clone(name=project_name,
-                                                    student=form.cleaned_data['student'],
-                                                    time_limit=form.cleaned_data['time_limit'])
+                # Clone the template in the background
+                queue_clone(template=form.cleaned_data['template'],
+                            name=project_name,
+                            student=form.cleaned_data['student'],
+                            time_limit=form.cleaned_data['time_limit'])
+                messages.info(request, _('{name} is being prepared').format(name=project_name))
 
                 if template:
                     if request.POST.get('_addanother'):
@@ -219,3 +213,75 @@ class StudentAddView(TemplateResponseMixin, ContextMixin, View):
         if 'redirect' in context:
             return redirect(context['redirect'])
         return self.render_to_response(context)
+
+
+class StudentsEnrollView(TemplateResponseMixin, ContextMixin, View):
+    template_name = 'admin/lab/template/students_enroll.html'
+
+    # Seconds between reloads of the page while clones are running
+    refresh_interval = 5
+
+    def get_context_data(self, request, object_id, **kwargs):
+        if not request.user.is_staff:
+            raise PermissionDenied("Not logged in")
+
+        template = get_object_or_404(Template, pk=object_id)
+        form_kwargs = {
+            'initial': {
+                'time_limit': template.default_time_limit,
+            }
+        }
+
+        if request.method == 'POST':
+            form = StudentsEnrollForm(request.POST, **form_kwargs)
+
+            if form.is_valid():
+                # The spooler clones for the whole class, we show how far it got
+                jobs = queue_clones(template=template,
+                                    students=form.cleaned_data['all_students'],
+                                    time_limit=form.cleaned_data['time_limit'],
+                                    concurrency=form.cleaned_data['concurrency'])
+                messages.success(request, _('{count} students queued for enrollment').format(count=len(jobs)))
+                return {
+                    'redirect': '{url}?jobs={jobs}'.format(
+                        url=reverse('admin:students_enroll', kwargs={'object_id': template.id}),
+                        jobs=','.join(str(job.id) for job in jobs),
+                    )
+                }
+        else:
+            form = StudentsEnrollForm(**form_kwargs)
+
+        report = None
+        job_ids = [job_id for job_id in request.GET.get('jobs', '').split(',') if job_id.isdigit()]
+        if job_ids:
+            jobs = CloneJob.objects.filter(template=template, id__in=job_ids) \
+                .select_related('student', 'exercise') \
+                .order_by('id')
+            report = EnrollmentReport.from_jobs(list(jobs))
+
+        fieldsets = [
+            Fieldset(form, fields=form.fields.keys())
+        ]
+
+        context = {
+            **admin.site.each_context(request),
+            'title': _('Enroll students in {template.name}').format(template=template),
+            'lab_app_name': LabConfig.verbose_name,
+            'template_name_plural': Template._meta.verbose_name_plural,
+            'template': template,
+            'adminform': fieldsets,
+            'report': report,
+            'refresh_interval': self.refresh_interval if report and report.pending else None,
+        }
+
+        return context
+
+    def get(self, *args, **kwargs):
+        context = self.get_context_data(*args, **kwargs)
+        return self.render_to_response(context)
+
+    def post(self, *args, **kwargs):
+        context = self.get_context_data(*args, **kwargs)
+        if 'redirect' in context:
+            return redirect(context['redirect'])
+        return self.render_to_response(context)
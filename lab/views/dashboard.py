@@ -1,101 +1,168 @@
+import hashlib
+import json
+
 from django.core.exceptions import PermissionDenied
-from django.http import HttpRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpRequest, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views import View
 from django.views.generic import TemplateView
 
-from lab.models import Exercise, ExerciseNode, IRRNode, MonitorNode, WorkNode
+from lab.models import Exercise, ExerciseNode, IRRGoal, IRRNode, MonitorGoal, MonitorNode, TemplateNode, WorkNode
 from lab.utils.diagram import ProjectDiagram
 
 
+def get_dashboard_nodes(exercise: Exercise) -> dict:
+    """
+    Describe the nodes of an exercise for the dashboard, with a fixed number of queries however many nodes there are
+    """
+    exercise_nodes = list(ExerciseNode.objects.filter(project=exercise).prefetch_related('exercisestate_set'))
+
+    # The template nodes with their monitor and IRR templates, as their most specific subclass
+    template_nodes = TemplateNode.objects \
+        .select_subclasses() \
+        .select_related('monitornode__monitor_template', 'irrnode__irr_template') \
+        .in_bulk([node.template_node_id for node in exercise_nodes])
+
+    # And the goals of those templates
+    goals = {}
+    monitor_template_ids = [template_node.monitor_template_id for template_node in template_nodes.values()
+                            if isinstance(template_node, MonitorNode) and template_node.monitor_template_id]
+    for goal in MonitorGoal.objects.filter(monitor_template_id__in=monitor_template_ids):
+        goals.setdefault((MonitorNode, goal.monitor_template_id), []).append(goal)
+
+    irr_template_ids = [template_node.irr_template_id for template_node in template_nodes.values()
+                        if isinstance(template_node, IRRNode) and template_node.irr_template_id]
+    for goal in IRRGoal.objects.filter(irr_template_id__in=irr_template_ids):
+        goals.setdefault((IRRNode, goal.irr_template_id), []).append(goal)
+
+    nodes = {}
+    for node in exercise_nodes:
+        template_node = template_nodes[node.template_node_id]
+
+        node_data = {
+            'id': node.id,
+            'gns3_id': node.gns3_id,
+            'name': node.name,
+            'type': template_node.__class__.__name__,
+            'info': dict(
+                instructions=template_node.instructions,
+            ),
+        }
+
+        if isinstance(template_node, (WorkNode, IRRNode)):
+            node_data['info'].update(dict(
+                username=template_node.default_username,
+                password=template_node.default_password,
+            ))
+
+        if isinstance(template_node, IRRNode):
+            node_data['info'].update(dict(
+                maintainer=template_node.maintainer,
+                maintainer_password=template_node.maintainer_password,
+            ))
+
+        if isinstance(template_node, (MonitorNode, IRRNode)):
+            node_state = {}
+
+            # Put in the goals
+            if isinstance(template_node, MonitorNode):
+                node_goals = goals.get((MonitorNode, template_node.monitor_template_id), [])
+            else:
+                node_goals = goals.get((IRRNode, template_node.irr_template_id), [])
+
+            for goal in node_goals:
+                node_state[goal.goal_type] = {
+                    'goal_type': goal.goal_type,
+                    'goal_type_display': goal.get_goal_type_display(),
+                    'state': '',
+                    'goal': goal.goal_content,
+                    'last_update': None,
+                }
+
+            # Completely skip MonitorNode if there are no goals
+            if not node_state:
+                continue
+
+            # Put in the states of those goals
+            for state in node.exercisestate_set.all():
+                if state.goal_type in node_state:
+                    node_state[state.goal_type]['state'] = state.state
+                    node_state[state.goal_type]['last_update'] = state.last_update
+
+            node_data['state'] = node_state
+
+        nodes[node.id] = node_data
+
+    return nodes
+
+
+def get_exercise_for_user(request: HttpRequest, project_id) -> Exercise:
+    if not request.user.is_authenticated:
+        raise PermissionDenied("Not logged in")
+
+    exercise = get_object_or_404(Exercise.objects.select_related('based_on'), pk=project_id)
+    if not request.user.is_staff and exercise.student_id != request.user.id:
+        raise PermissionDenied("No access to that exercise")
+
+    return exercise
+
+
+def get_dashboard_data(exercise: Exercise) -> dict:
+    return {
+        'exercise': {
+            'id': exercise.id,
+            'name': exercise.name,
+            'instructions': exercise.based_on.instructions,
+            'based_on': exercise.based_on.name,
+            'started': exercise.started,
+            'deadline': exercise.deadline,
+            'nodes': get_dashboard_nodes(exercise),
+        },
+        'diagram': ProjectDiagram(exercise).get_data(show_state=True),
+    }
+
+
+def get_dashboard_etag(data: dict) -> str:
+    """
+    A strong ETag for the dashboard data, covering everything in it: goals, instructions and credentials change
+    without leaving a trace anywhere else. It takes the whole payload, so a 304 only saves sending it, not building it.
+    """
+    version = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+    return quote_etag(hashlib.sha1(version.encode('utf-8')).hexdigest())
+
+
 class Dashboard(TemplateView):
     template_name = 'lab/dashboard.html'
 
     def get_context_data(self, request: HttpRequest, project_id, **kwargs):
-        if not request.user.is_authenticated:
-            raise PermissionDenied("Not logged in")
-
-        exercise = get_object_or_404(Exercise, pk=project_id)
-        if not request.user.is_staff and exercise.student != request.user:
-            raise PermissionDenied("No access to that exercise")
+        exercise = get_exercise_for_user(request, project_id)
 
         authorized = set(request.session.get('authorized_exercises', []))
         authorized.add(exercise.id)
         request.session['authorized_exercises'] = list(authorized)
 
-        nodes = {}
-        for node in exercise.node_set.select_subclasses():
-            assert isinstance(node, ExerciseNode)
-
-            node_data = {
-                'id': node.id,
-                'gns3_id': node.gns3_id,
-                'name': node.name,
-                'type': node.template_node.__class__.__name__,
-                'info': dict(
-                    instructions=node.template_node.instructions,
-                ),
-            }
-
-            if isinstance(node.template_node, (WorkNode, IRRNode)):
-                node_data['info'].update(dict(
-                    username=node.template_node.default_username,
-                    password=node.template_node.default_password,
-                ))
-
-            if isinstance(node.template_node, IRRNode):
-                node_data['info'].update(dict(
-                    maintainer=node.template_node.maintainer,
-                    maintainer_password=node.template_node.maintainer_password,
-                ))
-
-            if isinstance(node.template_node, (MonitorNode, IRRNode)):
-                node_state = {}
-
-                # Put in the goals
-                if isinstance(node.template_node, MonitorNode) and node.template_node.monitor_template:
-                    goals = node.template_node.monitor_template.monitorgoal_set.all()
-                elif isinstance(node.template_node, IRRNode) and node.template_node.irr_template:
-                    goals = node.template_node.irr_template.irrgoal_set.all()
-                else:
-                    goals = []
-
-                for goal in goals:
-                    node_state[goal.goal_type] = {
-                        'goal_type': goal.goal_type,
-                        'goal_type_display': goal.get_goal_type_display(),
-                        'state': '',
-                        'goal': goal.goal_content,
-                        'last_update': None,
-                    }
-
-                # Completely skip MonitorNode if there are no goals
-                if not node_state:
-                    continue
-
-                # Put in the states of those goals
-                states = node.exercisestate_set.filter(goal_type__in=node_state.keys())
-                for state in states:
-                    node_state[state.goal_type]['state'] = state.state
-                    node_state[state.goal_type]['last_update'] = state.last_update
-
-                node_data['state'] = node_state
-
-            nodes[node.id] = node_data
-
-        diagram = ProjectDiagram(exercise)
-        return {
-            'exercise': {
-                'id': exercise.id,
-                'name': exercise.name,
-                'instructions': exercise.based_on.instructions,
-                'based_on': exercise.based_on.name,
-                'started': exercise.started,
-                'deadline': exercise.deadline,
-                'nodes': nodes,
-            },
-            'diagram': diagram.get_data(show_state=True),
-        }
+        return get_dashboard_data(exercise)
 
     def get(self, *args, **kwargs):
         context = self.get_context_data(*args, **kwargs)
         return self.render_to_response(context)
+
+
+class DashboardStateView(View):
+    # noinspection PyMethodMayBeStatic
+    def get(self, request, project_id):
+        exercise = get_exercise_for_user(request, project_id)
+
+        # The payload is built either way, but clients that are up to date don't need to download it again
+        data = get_dashboard_data(exercise)
+        etag = get_dashboard_etag(data)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse(data)
+
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
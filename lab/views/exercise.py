@@ -1,13 +1,19 @@
-import time
-
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.views import View
 
 from lab.models import Exercise, ExerciseNode
-from lab.utils.gns3 import get_gns3_session, gns3_base_url
+from lab.tasks import queue_reload, queue_start, queue_stop
+
+
+def accepted_response(request, data: dict):
+    # Scripts get to know the job was accepted, browsers go back to the overview
+    if request.is_ajax() or 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+        return JsonResponse(data, status=202)
+
+    return HttpResponseRedirect('/')
 
 
 class StartExerciseView(View):
@@ -34,11 +40,10 @@ class StartExerciseView(View):
             project.deadline = None
             project.save()
 
-        project.gns3_start()
-        while not project.is_running():
-            time.sleep(0.2)
+        # Completion is announced on the events channel of the exercise
+        queued = queue_start(project)
 
-        return HttpResponseRedirect('/')
+        return accepted_response(request, {'exercise': project.id, 'action': 'start', 'queued': queued})
 
 
 class StopExerciseView(View):
@@ -55,11 +60,10 @@ class StopExerciseView(View):
         if not request.user.is_staff and project.student != request.user:
             raise PermissionDenied("No access to that exercise")
 
-        project.gns3_stop()
-        while project.is_running():
-            time.sleep(0.2)
+        # Completion is announced on the events channel of the exercise
+        queued = queue_stop(project)
 
-        return HttpResponseRedirect('/')
+        return accepted_response(request, {'exercise': project.id, 'action': 'stop', 'queued': queued})
 
 
 class ReloadNodeView(View):
@@ -72,13 +76,8 @@ class ReloadNodeView(View):
         if not request.user.is_staff and node.project.student != request.user:
             raise PermissionDenied("No access to that exercise")
 
-        session = get_gns3_session()
-        session.post(gns3_base_url + '/v2' +
-                     '/projects/' + str(node.project.gns3_id).lower() +
-                     '/nodes/' + str(node.gns3_id).lower() + '/stop')
-        time.sleep(1)
-        session.post(gns3_base_url + '/v2' +
-                     '/projects/' + str(node.project.gns3_id).lower() +
-                     '/nodes/' + str(node.gns3_id).lower() + '/start')
+        # Completion is announced on the events channel of the exercise
+        queued = queue_reload(node)
 
-        return HttpResponse()
+        return JsonResponse({'exercise': node.project_id, 'node': node.id, 'action': 'reload', 'queued': queued},
+                            status=202)
@@ -1,36 +1,33 @@
-from urllib.parse import quote
-
-from django.core.cache import cache
 from django.http import HttpResponse, HttpResponseNotFound
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from django.views import View
 from django.views.generic import TemplateView
 
 from lab.models import Project
 from lab.utils.diagram import ProjectDiagram
-from lab.utils.gns3 import get_gns3_session, gns3_base_url
+from lab.utils.symbols import get_symbol
+
+# Symbols hardly ever change, and when they do the ETag tells
+SYMBOL_MAX_AGE = 7 * 24 * 3600
 
 
 class SymbolView(View):
     @staticmethod
-    def get(_request, symbol_id, *_args, **_kwargs):
-        symbol = cache.get('symbol|' + symbol_id)
+    def get(request, symbol_id, *_args, **_kwargs):
+        symbol = get_symbol(symbol_id)
         if not symbol:
-            session = get_gns3_session()
-
-            # Check that it exists
-            symbols = session.get(gns3_base_url + '/v2/symbols').json()
-            for symbol in symbols:
-                if symbol['symbol_id'] == symbol_id:
-                    break
-            else:
-                return HttpResponseNotFound()
+            return HttpResponseNotFound()
 
-            # And retrieve
-            symbol = session.get(gns3_base_url + '/v2/symbols/' + quote(symbol_id) + '/raw')
-            cache.set('symbol|' + symbol_id, symbol, 3600)
+        etag = quote_etag(symbol.etag)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(symbol.data, content_type=symbol.content_type)
 
-        return HttpResponse(symbol, content_type=symbol.headers['content-type'])
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=SYMBOL_MAX_AGE)
+        return response
 
 
 class DrawingView(TemplateView):
@@ -38,6 +35,6 @@ class DrawingView(TemplateView):
 
     def get_context_data(self, project_id, show_state=True, **kwargs):
         context = super().get_context_data(**kwargs)
-        project = get_object_or_404(Project, pk=project_id)
+        project = get_object_or_404(Project.objects.select_subclasses(), pk=project_id)
         context.update(ProjectDiagram(project).get_data(show_state))
         return context
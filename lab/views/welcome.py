@@ -1,12 +1,13 @@
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
 from django.views import View
 from django.views.generic import TemplateView
 
-from lab.models import Template
+from lab.models import CloneJob, Template
+from lab.tasks import queue_clone
 
 
 def templates_for_user(user):
@@ -17,15 +18,26 @@ def templates_for_user(user):
         .filter(allow_new_exercises=True) \
         .exclude(id__in=user.exercise_set
                  .exclude(deadline__lt=timezone.now())
-                 .values_list('based_on_id', flat=True))
+                 .values_list('based_on_id', flat=True)) \
+        .exclude(id__in=user.clonejob_set
+                 .filter(state__in=CloneJob.pending_states)
+                 .values_list('template_id', flat=True))
 
 
 class Welcome(TemplateView):
     template_name = 'welcome.html'
 
     def get_context_data(self, request, **kwargs):
+        if request.user.is_authenticated:
+            # Allow following start and stop of the user's own exercises
+            authorized = set(request.session.get('authorized_exercises', []))
+            authorized.update(request.user.exercise_set.values_list('id', flat=True))
+            request.session['authorized_exercises'] = list(authorized)
+
         return {
             'templates': templates_for_user(request.user),
+            'jobs': request.user.clonejob_set.filter(state__in=CloneJob.pending_states)
+            if request.user.is_authenticated else CloneJob.objects.none(),
         }
 
     def get(self, *args, **kwargs):
@@ -45,15 +57,54 @@ class CloneTemplateView(View):
 
         template = get_object_or_404(templates_for_user(request.user), id=project_id)
 
-        # Add student name to project name
-        project_name = template.public_name + ' for ' + (request.user.get_full_name() or request.user.username)
+        project_name = template.get_exercise_name(request.user)
+
+        # Clone the template in the background
+        job = queue_clone(template=template,
+                          name=project_name,
+                          student=request.user,
+                          time_limit=template.default_time_limit)
 
-        # Clone the template
-        exercise = template.clone(name=project_name,
-                                  student=request.user,
-                                  time_limit=template.default_time_limit)
+        if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+            return JsonResponse({'job': job.id}, status=202)
 
-        # Redirect to the dashboard
-        return HttpResponseRedirect(reverse('project_dashboard', kwargs={
-            'project_id': exercise.id
+        # Show the progress
+        return HttpResponseRedirect(reverse('clone_job', kwargs={
+            'job_id': job.id
         }))
+
+
+class CloneJobView(TemplateView):
+    template_name = 'lab/clone_job.html'
+
+    def get_context_data(self, request, job_id, **kwargs):
+        if not request.user.is_authenticated:
+            raise PermissionDenied("Not logged in")
+
+        job = get_object_or_404(CloneJob, pk=job_id)
+        if not request.user.is_staff and job.student != request.user:
+            raise PermissionDenied("No access to that job")
+
+        return {
+            'job': job,
+        }
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(request, *args, **kwargs)
+
+        job = context['job']
+        if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+            return JsonResponse({
+                'job': job.id,
+                'state': job.state,
+                'state_display': job.get_state_display(),
+                'exercise': job.exercise_id,
+                'error': job.error,
+            })
+
+        if job.state == CloneJob.DONE and job.exercise_id:
+            return HttpResponseRedirect(reverse('project_dashboard', kwargs={
+                'project_id': job.exercise_id
+            }))
+
+        return self.render_to_response(context)
@@ -31,11 +31,65 @@ GNS3 = {
     'PORT': 3080,
     'USER': None,
     'PASSWORD': None,
+
+    # Connection pool to the GNS3 server, per process, and seconds to wait for a free connection in it
+    'POOL_SIZE': 10,
+    'POOL_TIMEOUT': 10,
+    'CONNECT_TIMEOUT': 5,
+    'READ_TIMEOUT': 120,
+
+    # How long (in seconds) starting or stopping an exercise may take
+    'POWER_TIMEOUT': 180,
+
+    # Where to keep the node symbols downloaded from GNS3
+    'SYMBOL_DIR': os.path.join(BASE_DIR, 'symbols'),
 }
 
 STATE_COLLECTOR = {
     'ADDRESS': socket.gethostbyname(socket.gethostname()),
     'PORT': 9000,
+
+    # Pending connections, and seconds between reports of the collector's metrics
+    'BACKLOG': 1024,
+    'METRICS_INTERVAL': 60,
+
+    # Seconds between writes of changed states to the database
+    'FLUSH_INTERVAL': 2,
+
+    # Seconds after which an unchanged state is forwarded to the dashboards again
+    'RESEND_INTERVAL': 30,
+
+    # Worker processes sharing the port, each with its own connections
+    'SHARDS': 1,
+
+    # Bytes of commands waiting for a monitor before new commands are refused
+    'SEND_HIGH_WATER': 1048576,
+}
+
+TELNET_RELAY = {
+    # Seconds to wait for a console to accept the connection
+    'CONNECT_TIMEOUT': 5,
+
+    # Console output is published after this many seconds, or when this many bytes are waiting
+    'BATCH_DELAY': 0.005,
+    'BATCH_SIZE': 16384,
+
+    # Terminal output as 'json' with base64, or as 'compact' text frames without either
+    'FRAME_FORMAT': 'json',
+
+    # Bytes of recent output kept per console for terminals that open later, and for all consoles together
+    'HISTORY_SIZE': 65536,
+    'HISTORY_LIMIT': 67108864,
+
+    # Seconds between checks for open terminals, without which consoles are paused, and for unused consoles
+    'VIEWER_INTERVAL': 5,
+    'IDLE_TIMEOUT': 1800,
+
+    # Seconds without a sign of life from a terminal before it counts as closed, terminals report every 10 seconds
+    'VIEWER_TIMEOUT': 30,
+
+    # Seconds between reports of the relay's metrics
+    'METRICS_INTERVAL': 60,
 }
 
 # Application definition
@@ -0,0 +1,13 @@
+# Settings for the test suite, without Redis or a deployment's local settings:
+#   python manage.py test --settings=labmgr.test_settings
+from .default_settings import *
+
+SECRET_KEY = 'only-for-tests'
+
+# One process, so a local cache does the job of Redis
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}